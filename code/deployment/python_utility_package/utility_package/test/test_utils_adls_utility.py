@@ -0,0 +1,391 @@
+from datetime import datetime, timezone
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch, Mock
+
+from azure.core.exceptions import ResourceNotFoundError
+import pandas as pd
+
+from utility_package.utils.adls_utility import ADLSFileWriter, ADLSInterface
+
+
+sa_name = 'testsa'
+file_system = 'test-fs'
+spn_credentials = {
+    'tenant_id': 'tenant_id',
+    'spn_id': 'spn_id',
+    'spn_password': 'spn_password'
+}
+test_module_name = 'utility_package.utils.adls_utility'
+
+
+def get_appended(mock_file_client):
+    return sorted(
+        (call[0] for call in mock_file_client.append_data.call_args_list),
+        key=lambda args: args[1])
+
+
+def get_path(name, size=0, last_modified=None, is_directory=False):
+    path = Mock(
+        is_directory=is_directory, content_length=size,
+        last_modified=last_modified)
+    path.name = name
+    return path
+
+
+def get_downloader(data):
+    def readinto(file):
+        file.write(data)
+        return len(data)
+
+    downloader = Mock(size=len(data))
+    downloader.readinto.side_effect = readinto
+    return downloader
+
+
+def write_file(file_path, data, mtime=None):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as file:
+        file.write(data)
+    if mtime is not None:
+        os.utime(file_path, (mtime, mtime))
+
+
+class TestADLSFileWriter(TestCase):
+    def test_write_offsets(self):
+        mock_file_client = Mock()
+        with ADLSFileWriter(mock_file_client, chunk_size=4) as writer:
+            self.assertEqual(writer.write(b'abcdefghij'), 10)
+            writer.write('kl')
+            writer.write(b'm')
+        mock_file_client.create_file.assert_called_once()
+        self.assertEqual(get_appended(mock_file_client), [
+            (b'abcd', 0, 4),
+            (b'efgh', 4, 4),
+            (b'ijkl', 8, 4),
+            (b'm', 12, 1)
+        ])
+        mock_file_client.flush_data.assert_called_once_with(13)
+        mock_file_client.rename_file.assert_not_called()
+
+    def test_large_write_is_split(self):
+        mock_file_client = Mock()
+        writer = ADLSFileWriter(
+            mock_file_client, chunk_size=3, max_in_flight=2)
+        writer.write(b'x' * 10)
+        writer.close()
+        writer.close()
+        appended = get_appended(mock_file_client)
+        self.assertEqual([length for _, _, length in appended], [3, 3, 3, 1])
+        self.assertEqual([offset for _, offset, _ in appended], [0, 3, 6, 9])
+        mock_file_client.flush_data.assert_called_once_with(10)
+        with self.assertRaises(ValueError):
+            writer.write(b'y')
+
+    def test_abort_on_exception(self):
+        mock_file_client = Mock()
+        with self.assertRaises(RuntimeError):
+            with ADLSFileWriter(
+                mock_file_client, chunk_size=4, rename_to='fs/out.csv'
+            ) as writer:
+                writer.write(b'abcdef')
+                raise RuntimeError('failed')
+        mock_file_client.flush_data.assert_not_called()
+        mock_file_client.rename_file.assert_not_called()
+        mock_file_client.delete_file.assert_called_once()
+
+    def test_failed_append_aborts(self):
+        mock_file_client = Mock()
+        mock_file_client.append_data.side_effect = OSError('failed')
+        writer = ADLSFileWriter(
+            mock_file_client, chunk_size=4, rename_to='fs/out.csv')
+        writer.write(b'ab')
+        with self.assertRaises(OSError):
+            writer.close()
+        mock_file_client.flush_data.assert_not_called()
+        mock_file_client.delete_file.assert_called_once()
+
+
+class TestADLSInterface(TestCase):
+    @patch(f'{test_module_name}.ClientSecretCredential')
+    @patch(f'{test_module_name}.DataLakeServiceClient')
+    def get_adls(self, mock_service_client, _):
+        adls = ADLSInterface(sa_name, spn_credentials, shared_client=False)
+        self.assertEqual(adls.service_client, mock_service_client.return_value)
+        return adls
+
+    def test_open_writer_renames_temp_file(self):
+        adls = self.get_adls()
+        mock_file_client = Mock(file_system_name=file_system)
+        adls.service_client.get_file_client.return_value = mock_file_client
+        with adls.open_writer('out/data.csv', file_system) as writer:
+            writer.write(b'abc')
+        _, temp_path = adls.service_client.get_file_client.call_args[0]
+        self.assertTrue(temp_path.startswith('out/.data.csv.'))
+        self.assertTrue(temp_path.endswith('.tmp'))
+        mock_file_client.flush_data.assert_called_once_with(3)
+        mock_file_client.rename_file.assert_called_once_with(
+            f'{file_system}/out/data.csv')
+
+    def test_save_df_to_csv(self):
+        adls = self.get_adls()
+        mock_file_client = Mock(file_system_name=file_system)
+        adls.service_client.get_file_client.return_value = mock_file_client
+        input_df = pd.DataFrame({'a': range(5), 'b': list('vwxyz')})
+        adls.save_df_to_csv(input_df, 'out.csv', file_system, chunk_rows=2)
+        data = b''.join(
+            data for data, _, _ in get_appended(mock_file_client))
+        self.assertEqual(data, input_df.to_csv(index=False).encode('utf-8'))
+
+    def test_track_changes(self):
+        adls = self.get_adls()
+        mock_file_system_client = (
+            adls.service_client.get_file_system_client.return_value)
+        paths = [
+            Mock(is_directory=True),
+            Mock(is_directory=False, content_length=1, etag='1',
+                 last_modified='2021-01-01')
+        ]
+        paths[1].name = 'data/a.csv'
+        mock_file_system_client.get_paths.return_value = paths
+        manifest_path = os.path.join(tempfile.mkdtemp(), 'manifest.json.gz')
+
+        tracker = adls.track_changes(file_system, manifest_path, 'data')
+        changed, deleted = tracker.get_changes()
+        self.assertEqual(changed, [paths[1]])
+        self.assertEqual(deleted, [])
+        mock_file_system_client.get_paths.assert_called_once_with(
+            path='data', recursive=True)
+        tracker.commit()
+        changed, _ = adls.track_changes(
+            file_system, manifest_path, 'data').get_changes()
+        self.assertEqual(changed, [])
+
+    def set_local_timezone(self, name):
+        # naive last_modified values must not be read as local time
+        environ = patch.dict(os.environ, {'TZ': name})
+        environ.start()
+        time.tzset()
+        self.addCleanup(time.tzset)
+        self.addCleanup(environ.stop)
+
+    def test_download_directory(self):
+        self.set_local_timezone('Asia/Tokyo')
+        adls = self.get_adls()
+        last_modified = datetime(2021, 1, 1, 12, 0)
+        mtime = last_modified.replace(tzinfo=timezone.utc).timestamp()
+        contents = {
+            'data/a.csv': b'abc',
+            'data/sub/b.csv': b'hello',
+            'data/sub/c.csv': None
+        }
+        mock_file_system_client = (
+            adls.service_client.get_file_system_client.return_value)
+        mock_file_system_client.get_paths.return_value = [
+            get_path('data/sub', is_directory=True)
+        ] + [
+            get_path(name, len(data or b''), last_modified)
+            for name, data in contents.items()
+        ]
+
+        def get_file_client(_, path):
+            mock_file_client = Mock()
+            if contents[path] is None:
+                mock_file_client.download_file.side_effect = OSError(path)
+            else:
+                mock_file_client.download_file.return_value = (
+                    get_downloader(contents[path]))
+            return mock_file_client
+
+        adls.service_client.get_file_client.side_effect = get_file_client
+        local_dir = tempfile.mkdtemp()
+        # a current file is skipped, a stale partial download is replaced
+        write_file(os.path.join(local_dir, 'a.csv'), b'abc', mtime)
+        write_file(os.path.join(local_dir, 'sub', 'b.csv.part'), b'he')
+
+        stats = adls.download_directory('/data/', file_system, local_dir)
+        self.assertEqual(stats['transferred'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['bytes'], 5)
+        self.assertEqual(
+            [(name, str(error)) for name, error in stats['failed']],
+            [('data/sub/c.csv', 'data/sub/c.csv')])
+        mock_file_system_client.get_paths.assert_called_once_with(
+            path='data', recursive=True)
+        local_path = os.path.join(local_dir, 'sub', 'b.csv')
+        with open(local_path, 'rb') as file:
+            self.assertEqual(file.read(), b'hello')
+        self.assertEqual(os.stat(local_path).st_mtime, mtime)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(local_dir, 'sub'))), ['b.csv'])
+
+        # running it again resumes with only the failed file
+        contents['data/sub/c.csv'] = b'xyz'
+        stats = adls.download_directory('data', file_system, local_dir)
+        self.assertEqual(
+            (stats['transferred'], stats['skipped'], stats['failed']),
+            (1, 2, []))
+
+    def test_upload_directory(self):
+        self.set_local_timezone('America/New_York')
+        adls = self.get_adls()
+        local_dir = tempfile.mkdtemp()
+        mtime = datetime(2021, 1, 1, 12, 0, tzinfo=timezone.utc).timestamp()
+        write_file(os.path.join(local_dir, 'a.csv'), b'abc', mtime)
+        write_file(os.path.join(local_dir, 'sub', 'b.csv'), b'hello', mtime)
+        write_file(os.path.join(local_dir, 'sub', 'c.csv'), b'xyz', mtime)
+        mock_file_system_client = (
+            adls.service_client.get_file_system_client.return_value)
+        # same size and modified (in naive UTC) after the local file
+        mock_file_system_client.get_paths.return_value = [
+            get_path('out/a.csv', 3, datetime(2021, 1, 1, 12, 1)),
+            get_path('out/sub/b.csv', 5, datetime(2021, 1, 1, 11, 59))
+        ]
+        file_clients = {}
+
+        def get_file_client(_, path):
+            mock_file_client = Mock()
+            if path.endswith('c.csv'):
+                mock_file_client.upload_data.side_effect = OSError(path)
+            file_clients[path] = mock_file_client
+            return mock_file_client
+
+        adls.service_client.get_file_client.side_effect = get_file_client
+
+        stats = adls.upload_directory(local_dir, 'out/', file_system)
+        self.assertEqual(stats['transferred'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['bytes'], 5)
+        self.assertEqual(
+            [name for name, _ in stats['failed']], ['out/sub/c.csv'])
+        self.assertEqual(
+            sorted(file_clients), ['out/sub/b.csv', 'out/sub/c.csv'])
+        upload_data = file_clients['out/sub/b.csv'].upload_data
+        self.assertEqual(
+            upload_data.call_args[1], {'length': 5, 'overwrite': True})
+
+        # a missing remote directory is uploaded in full
+        mock_file_system_client.get_paths.side_effect = (
+            ResourceNotFoundError('not found'))
+        file_clients.clear()
+        stats = adls.upload_directory(local_dir, 'out', file_system)
+        self.assertEqual(
+            (stats['transferred'], stats['skipped'], len(stats['failed'])),
+            (2, 0, 1))
+        self.assertEqual(sorted(file_clients), [
+            'out/a.csv', 'out/sub/b.csv', 'out/sub/c.csv'])
+
+    def get_mock_file_client(self, adls, data, chunk_size=2):
+        mock_file_client = Mock()
+        adls.service_client.get_file_client.return_value = mock_file_client
+        mock_downloader = get_downloader(data)
+        mock_downloader.chunks.side_effect = (
+            lambda: iter([data[i: i + chunk_size]
+                          for i in range(0, len(data), chunk_size)]))
+        mock_file_client.download_file.return_value = mock_downloader
+        return mock_file_client
+
+    def test_get_file(self):
+        adls = self.get_adls()
+        self.get_mock_file_client(adls, b'abcde')
+        buffer = adls.get_file('data/a.csv', file_system)
+        self.assertEqual(buffer.tell(), 0)
+        self.assertEqual(buffer.read(), b'abcde')
+        adls.service_client.get_file_client.assert_called_once_with(
+            file_system, 'data/a.csv')
+
+    def test_iter_file_chunks(self):
+        adls = self.get_adls()
+        self.get_mock_file_client(adls, b'abcde')
+        self.assertEqual(
+            list(adls.iter_file_chunks('data/a.csv', file_system)),
+            [b'ab', b'cd', b'e'])
+
+    def test_readinto_file(self):
+        adls = self.get_adls()
+        mock_file_client = self.get_mock_file_client(adls, b'abcde')
+        with tempfile.TemporaryFile() as file:
+            file.write(b'header')
+            self.assertEqual(
+                adls.readinto('data/a.csv', file_system, file, 4), 5)
+            file.seek(0)
+            self.assertEqual(file.read(), b'headerabcde')
+        mock_file_client.download_file.assert_called_once_with(
+            max_concurrency=4)
+
+    def test_readinto_buffer(self):
+        adls = self.get_adls()
+        self.get_mock_file_client(adls, b'abcde')
+        buffer = bytearray(b'.' * 7)
+        self.assertEqual(adls.readinto('data/a.csv', file_system, buffer), 5)
+        self.assertEqual(buffer, bytearray(b'abcde..'))
+        # a memoryview of any format is filled byte by byte
+        array = memoryview(bytearray(8)).cast('I')
+        self.assertEqual(adls.readinto('data/a.csv', file_system, array), 5)
+        self.assertEqual(array.tobytes(), b'abcde\x00\x00\x00')
+
+    def test_readinto_buffer_too_small(self):
+        adls = self.get_adls()
+        self.get_mock_file_client(adls, b'abcde')
+        buffer = bytearray(4)
+        with self.assertRaises(ValueError):
+            adls.readinto('data/a.csv', file_system, buffer)
+        self.assertEqual(buffer, bytearray(4))
+
+    def test_read_range(self):
+        adls = self.get_adls()
+        mock_file_client = self.get_mock_file_client(adls, b'')
+        mock_file_client.download_file.return_value.readall.return_value = (
+            b'footer')
+        self.assertEqual(
+            adls.read_range('a.parquet', file_system, 10, 6), b'footer')
+        mock_file_client.download_file.assert_called_once_with(
+            offset=10, length=6)
+
+    def test_download_to_file(self):
+        adls = self.get_adls()
+        mock_file_client = self.get_mock_file_client(adls, b'abcde')
+        preallocated = []
+        mock_downloader = mock_file_client.download_file.return_value
+        readinto = mock_downloader.readinto.side_effect
+
+        def check_preallocated(file):
+            preallocated.append(os.fstat(file.fileno()).st_size)
+            return readinto(file)
+
+        mock_downloader.readinto.side_effect = check_preallocated
+        file_path = os.path.join(tempfile.mkdtemp(), 'a.bin')
+        self.assertEqual(adls.download_to_file(
+            'a.bin', file_system, file_path, max_concurrency=4), 5)
+        self.assertEqual(preallocated, [5])
+        mock_file_client.download_file.assert_called_once_with(
+            max_concurrency=4)
+        mapped = adls.download_to_file(
+            'a.bin', file_system, file_path, as_mmap=True)
+        self.assertEqual(mapped[:], b'abcde')
+        mapped.close()
+
+        # an empty file cannot be mapped
+        self.get_mock_file_client(adls, b'')
+        self.assertEqual(adls.download_to_file(
+            'empty.bin', file_system, file_path, as_mmap=True), b'')
+
+    def test_open_file(self):
+        adls = self.get_adls()
+        mock_file_client = self.get_mock_file_client(adls, b'')
+        data = bytes(range(100))
+        mock_file_client.get_file_properties.return_value.size = len(data)
+        mock_file_client.download_file.side_effect = (
+            lambda offset, length: Mock(
+                readall=Mock(return_value=data[offset: offset + length])))
+        with adls.open_file('a.bin', file_system, block_size=16) as file:
+            file.seek(-10, os.SEEK_END)
+            self.assertEqual(file.read(), data[90:])
+            file.seek(20)
+            self.assertEqual(file.read(2), data[20:22])
+        calls = mock_file_client.download_file.call_args_list
+        self.assertEqual(
+            [call[1] for call in calls],
+            [{'offset': 90, 'length': 10}, {'offset': 20, 'length': 16}])
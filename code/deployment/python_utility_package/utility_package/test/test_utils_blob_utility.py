@@ -0,0 +1,499 @@
+from collections import defaultdict
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, Mock
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobPrefix
+import pandas as pd
+
+from utility_package.utils.blob_utility import (
+    BlobConnection, _iter_json, _iter_json_array, _iter_ndjson, zstandard)
+from utility_package.utils.disk_cache_utility import DiskCache
+
+
+blob_conn_str = 'DefaultEndpointsProtocol=https;AccountName=testsa'
+container = 'test-container'
+test_module_name = 'utility_package.utils.blob_utility'
+
+
+records = [
+    {'id': 1, 'price': 12.5, 'tags': ['a,b', ']'], 'quote': 'say "hi"'},
+    {'id': 22, 'name': 'caf\u00e9 \u20ac \U0001f600', 'nested': {'x': []}},
+    [1, 2.75e3, None, True],
+    'text',
+    1234567,
+    -0.5
+]
+
+
+def split(data, size):
+    return [data[i: i + size] for i in range(0, len(data), size)]
+
+
+def get_staged_data(mock_blob_client):
+    staged = {
+        call[0][0]: call[0][1]
+        for call in mock_blob_client.stage_block.call_args_list
+    }
+    block_ids = mock_blob_client.commit_block_list.call_args[0][0]
+    return [staged[block_id] for block_id in block_ids]
+
+
+def get_blob(name, etag, size=1):
+    blob = Mock(size=size, etag=etag, last_modified='2021-01-01')
+    blob.name = name
+    return blob
+
+
+def get_prefix(name):
+    prefix = Mock(spec=BlobPrefix)
+    prefix.name = name
+    return prefix
+
+
+class TestIterJson(TestCase):
+    def test_json_array_all_chunk_sizes(self):
+        data = json.dumps(records, ensure_ascii=False).encode('utf-8')
+        for size in range(1, len(data) + 1):
+            self.assertEqual(
+                list(_iter_json_array(split(data, size))), records,
+                f'chunk size {size}')
+
+    def test_json_array_number_at_chunk_end(self):
+        # '12' must not be taken as a complete value before '34' arrives
+        self.assertEqual(
+            list(_iter_json_array([b'[12', b'34, 5', b'.5', b'e1]'])),
+            [1234, 55.0])
+        self.assertEqual(list(_iter_json_array([b'[1', b']'])), [1])
+
+    def test_json_array_utf8_split(self):
+        data = json.dumps(['\u20ac\U0001f600'], ensure_ascii=False).encode()
+        # every split point, including inside multi-byte characters
+        for i in range(len(data)):
+            self.assertEqual(
+                list(_iter_json_array([data[:i], data[i:]])),
+                ['\u20ac\U0001f600'])
+
+    def test_json_array_empty(self):
+        self.assertEqual(list(_iter_json_array([b' [ ', b' ] '])), [])
+
+    def test_json_array_malformed(self):
+        for chunks in [
+            [b'{"a": 1}'],
+            [b'[1, 2'],
+            [b'[1 2]'],
+            [b'[1,', b' tru'],
+            [b'[{"a": 1]'],
+            [b''],
+        ]:
+            with self.assertRaises(ValueError, msg=repr(chunks)):
+                list(_iter_json_array(chunks))
+
+    def test_ndjson_all_chunk_sizes(self):
+        data = '\n'.join(
+            json.dumps(record, ensure_ascii=False) for record in records
+        ).encode('utf-8') + b'\n\n'
+        for size in range(1, len(data) + 1):
+            self.assertEqual(
+                list(_iter_ndjson(split(data, size))), records,
+                f'chunk size {size}')
+
+    def test_ndjson_without_trailing_newline(self):
+        self.assertEqual(
+            list(_iter_ndjson([b'{"a": 1}\r\n{"a"', b': 2}'])),
+            [{'a': 1}, {'a': 2}])
+
+    def test_ndjson_malformed(self):
+        with self.assertRaises(ValueError):
+            list(_iter_ndjson([b'{"a": 1}\n{"a": \n']))
+
+    def test_auto_detection(self):
+        array_data = [b'', b'  \n', b' [{"a": 1}', b', {"a": 2}]']
+        ndjson_data = [b'', b'\n', b'{"a": 1}\n', b'{"a": 2}\n']
+        for chunks in [array_data, ndjson_data]:
+            self.assertEqual(
+                list(_iter_json(chunks)), [{'a': 1}, {'a': 2}])
+        self.assertEqual(
+            list(_iter_json(array_data, json_format='array')),
+            [{'a': 1}, {'a': 2}])
+        # an array read as ndjson is a single document
+        self.assertEqual(
+            list(_iter_json([b'[1, 2]'], json_format='ndjson')), [[1, 2]])
+        self.assertEqual(list(_iter_json([])), [])
+        with self.assertRaises(ValueError):
+            _iter_json([b'[]'], json_format='csv')
+
+
+class TestBlobConnection(TestCase):
+    @patch(f'{test_module_name}.BlobServiceClient')
+    def get_blob_conn(self, mock_blob_service_client):
+        blob_conn = BlobConnection(blob_conn_str, shared_client=False)
+        mock_from_connection_string = (
+            mock_blob_service_client.from_connection_string)
+        mock_from_connection_string.assert_called_once_with(blob_conn_str)
+        return blob_conn
+
+    def test_track_changes(self):
+        blob_conn = self.get_blob_conn()
+        mock_container_client = (
+            blob_conn.blob_service_client.get_container_client.return_value)
+        mock_container_client.list_blobs.return_value = [
+            get_blob('a.json', '1'), get_blob('b.json', '1')]
+        manifest_path = os.path.join(tempfile.mkdtemp(), 'manifest.json.gz')
+
+        tracker = blob_conn.track_changes(container, manifest_path, depth=0)
+        changed, deleted = tracker.get_changes()
+        self.assertEqual([blob.name for blob in changed], ['a.json', 'b.json'])
+        self.assertEqual(deleted, [])
+        # nothing is recorded until the changes are committed
+        self.assertFalse(os.path.exists(manifest_path))
+        changed, _ = blob_conn.track_changes(
+            container, manifest_path, depth=0).get_changes()
+        self.assertEqual(len(changed), 2)
+
+        tracker.commit()
+        mock_container_client.list_blobs.return_value = [
+            get_blob('a.json', '2')]
+        tracker = blob_conn.track_changes(container, manifest_path, depth=0)
+        changed, deleted = tracker.get_changes()
+        self.assertEqual([blob.name for blob in changed], ['a.json'])
+        self.assertEqual(deleted, ['b.json'])
+        with self.assertRaises(ValueError):
+            blob_conn.track_changes(container, manifest_path).commit()
+
+    def test_list_files_parallel(self):
+        blob_conn = self.get_blob_conn()
+        mock_container_client = (
+            blob_conn.blob_service_client.get_container_client.return_value)
+        blob_names = [
+            'data/a.json', 'data/x/b.json', 'data/x/y/c.json',
+            'data/x/y/z/d.json', 'data/w/e.json']
+
+        def walk_blobs(name_starts_with, delimiter):
+            self.assertEqual(delimiter, '/')
+            name_starts_with = name_starts_with or ''
+            items = {}
+            for blob_name in blob_names:
+                if not blob_name.startswith(name_starts_with):
+                    continue
+                head, sep, _ = blob_name[len(name_starts_with):].partition(
+                    delimiter)
+                if sep:
+                    name = name_starts_with + head + sep
+                    items[name] = get_prefix(name)
+                else:
+                    items[blob_name] = get_blob(blob_name, '1')
+            return iter(items.values())
+
+        def list_blobs(name_starts_with=None):
+            return iter(
+                get_blob(blob_name, '1') for blob_name in blob_names
+                if blob_name.startswith(name_starts_with or ''))
+
+        mock_container_client.walk_blobs.side_effect = walk_blobs
+        mock_container_client.list_blobs.side_effect = list_blobs
+        for depth in range(5):
+            mock_container_client.walk_blobs.reset_mock()
+            mock_container_client.list_blobs.reset_mock()
+            blobs = blob_conn.list_files_parallel(
+                container, 'data', depth=depth, max_workers=2)
+            self.assertEqual(
+                sorted(blob.name for blob in blobs), sorted(blob_names),
+                f'depth {depth}')
+            self.assertEqual(
+                mock_container_client.walk_blobs.call_count,
+                [0, 1, 3, 4, 5][depth])
+
+        # the prefixes found two levels down are listed
+        mock_container_client.list_blobs.reset_mock()
+        blobs = list(blob_conn.list_files_parallel(container, depth=2))
+        self.assertEqual(len(blobs), 5)
+        self.assertEqual(
+            sorted(
+                call[1]['name_starts_with'] for call in
+                mock_container_client.list_blobs.call_args_list),
+            ['data/w/', 'data/x/'])
+
+    def test_iter_json_df_batches(self):
+        blob_conn = self.get_blob_conn()
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        data = json.dumps([{'a': i} for i in range(5)]).encode('utf-8')
+        mock_blob_client.download_blob.return_value.chunks.return_value = (
+            split(data, 7))
+        batches = list(blob_conn.iter_json_df_batches(
+            container, 'data.json', batch_rows=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(list(batches[2]['a']), [4])
+
+    def test_get_file_cached(self):
+        blob_conn = self.get_blob_conn()
+        blob_conn.cache = DiskCache(tempfile.mkdtemp())
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        mock_blob_client.account_name = 'testsa'
+        mock_downloader = mock_blob_client.download_blob.return_value
+        mock_downloader.readall.return_value = b'data'
+        mock_downloader.properties.etag = '"etag1"'
+        blob_conn.get_file(container, 'a.json')
+        data = blob_conn.get_file(container, 'a.json')
+        self.assertEqual(data.readall(), b'data')
+        self.assertEqual(data.name, 'a.json')
+        self.assertEqual(data.properties.etag, '"etag1"')
+        self.assertEqual(
+            mock_blob_client.download_blob.call_args[1]['etag'], '"etag1"')
+
+    @patch(f'{test_module_name}.MIN_BLOCK_BYTES', 1)
+    def test_save_df_to_csv_in_blocks(self):
+        blob_conn = self.get_blob_conn()
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        input_df = pd.DataFrame({'a': range(5), 'b': list('vwxyz')})
+        blob_conn.save_df_to_csv(
+            input_df, container, 'out.csv', chunk_rows=2, max_concurrency=2)
+        blocks = get_staged_data(mock_blob_client)
+        block_ids = mock_blob_client.commit_block_list.call_args[0][0]
+        self.assertEqual(block_ids, sorted(block_ids))
+        # one block per chunk, the header only in the first one
+        self.assertEqual(blocks, [
+            b'a,b\n0,v\n1,w\n', b'2,x\n3,y\n', b'4,z\n'])
+
+    @patch(f'{test_module_name}.MIN_BLOCK_BYTES', 1)
+    def test_save_df_to_csv_compressed(self):
+        blob_conn = self.get_blob_conn()
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        input_df = pd.DataFrame({'a': range(1000), 'b': 'x'})
+        expected = input_df.to_csv(index=False).encode('utf-8')
+        blob_conn.save_df_to_csv(
+            input_df, container, 'out.csv.gz', chunk_rows=100,
+            compression='gzip')
+        data = b''.join(get_staged_data(mock_blob_client))
+        self.assertEqual(gzip.decompress(data), expected)
+        if zstandard is not None:
+            blob_conn.save_df_to_csv(
+                input_df, container, 'out.csv.zst', chunk_rows=100,
+                compression='zstd')
+            data = b''.join(get_staged_data(mock_blob_client))
+            self.assertEqual(
+                zstandard.ZstdDecompressor().decompressobj().decompress(data),
+                expected)
+        with self.assertRaises(ValueError):
+            blob_conn.save_df_to_csv(
+                input_df, container, 'out.csv', compression='bz2')
+
+    def test_save_df_to_csv_in_blocks_empty(self):
+        blob_conn = self.get_blob_conn()
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        input_df = pd.DataFrame(columns=['a', 'b'])
+        blob_conn.save_df_to_csv(input_df, container, 'out.csv', chunk_rows=2)
+        self.assertEqual(get_staged_data(mock_blob_client), [b'a,b\n'])
+
+    def test_save_file_skip_unchanged(self):
+        blob_conn = self.get_blob_conn()
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        mock_properties = mock_blob_client.get_blob_properties.return_value
+        mock_properties.content_settings.content_md5 = bytearray(
+            hashlib.md5(b'data').digest())
+        self.assertFalse(blob_conn.save_file(
+            b'data', container, 'a.bin', skip_unchanged=True))
+        mock_blob_client.upload_blob.assert_not_called()
+
+        self.assertTrue(blob_conn.save_file(
+            'new data', container, 'a.bin', skip_unchanged=True))
+        content_settings = (
+            mock_blob_client.upload_blob.call_args[1]['content_settings'])
+        self.assertEqual(
+            content_settings.content_md5, hashlib.md5(b'new data').digest())
+
+        mock_blob_client.get_blob_properties.side_effect = (
+            ResourceNotFoundError('not found'))
+        self.assertTrue(blob_conn.save_json(
+            {'a': 1}, container, 'a.json', skip_unchanged=True))
+        self.assertEqual(mock_blob_client.upload_blob.call_count, 2)
+        # without skip_unchanged the properties are not read
+        mock_blob_client.get_blob_properties.reset_mock()
+        self.assertTrue(blob_conn.save_file(b'data', container, 'a.bin'))
+        mock_blob_client.get_blob_properties.assert_not_called()
+
+    def get_blob_clients(self, blob_conn):
+        blob_clients = defaultdict(Mock)
+        blob_conn.blob_service_client.get_blob_client.side_effect = (
+            lambda container, blob: blob_clients[blob])
+        return blob_clients
+
+    def test_download_many(self):
+        blob_conn = self.get_blob_conn()
+        blob_clients = self.get_blob_clients(blob_conn)
+        for blob_path in ['a.json', 'b.json']:
+            mock_downloader = blob_clients[blob_path].download_blob()
+            mock_downloader.readall.return_value = blob_path.encode()
+        blob_clients['missing.json'].download_blob.side_effect = (
+            ResourceNotFoundError('not found'))
+
+        results = sorted(
+            blob_conn.download_many(
+                container, ['b.json', 'missing.json', 'a.json'],
+                max_workers=2),
+            key=lambda result: result[0])
+        self.assertEqual(
+            [(blob_path, data) for blob_path, data, _ in results],
+            [('a.json', b'a.json'), ('b.json', b'b.json'),
+             ('missing.json', None)])
+        self.assertIsNone(results[0][2])
+        # one failed download does not stop the others
+        self.assertIsInstance(results[2][2], ResourceNotFoundError)
+
+    def test_upload_many(self):
+        blob_conn = self.get_blob_conn()
+        blob_clients = self.get_blob_clients(blob_conn)
+        properties = blob_clients['unchanged.bin'].get_blob_properties()
+        properties.content_settings.content_md5 = bytearray(
+            hashlib.md5(b'same').digest())
+        for blob_path in ['bad.bin', 'new.bin']:
+            blob_clients[blob_path].get_blob_properties.side_effect = (
+                ResourceNotFoundError('not found'))
+        blob_clients['bad.bin'].upload_blob.side_effect = OSError('failed')
+        items = [
+            ('unchanged.bin', b'same'), ('bad.bin', b'x'), ('new.bin', 'new')]
+
+        results = {
+            blob_path: (result, error)
+            for blob_path, result, error in blob_conn.upload_many(
+                container, iter(items), max_workers=2, skip_unchanged=True)
+        }
+        self.assertEqual(results['unchanged.bin'], (False, None))
+        self.assertEqual(results['new.bin'], (True, None))
+        self.assertIsNone(results['bad.bin'][0])
+        self.assertIsInstance(results['bad.bin'][1], OSError)
+        blob_clients['unchanged.bin'].upload_blob.assert_not_called()
+        self.assertEqual(
+            blob_clients['new.bin'].upload_blob.call_args[0][0], b'new')
+
+        # without skip_unchanged every blob is uploaded
+        results = list(blob_conn.upload_many(container, items[:1]))
+        self.assertEqual(results, [('unchanged.bin', True, None)])
+        blob_clients['unchanged.bin'].upload_blob.assert_called_once()
+
+    def test_delete_blobs_batch(self):
+        blob_conn = self.get_blob_conn()
+        mock_container_client = (
+            blob_conn.blob_service_client.get_container_client.return_value)
+
+        def delete_blobs(*blob_paths, **kwargs):
+            if 'blob600' in blob_paths:
+                raise OSError('batch failed')
+            return [
+                Mock(status_code=404, reason='BlobNotFound')
+                if blob_path == 'blob7' else Mock(status_code=202, reason='')
+                for blob_path in blob_paths
+            ]
+
+        mock_container_client.delete_blobs.side_effect = delete_blobs
+        blob_paths = (f'blob{i}' for i in range(700))
+        stats = blob_conn.delete_blobs_batch(container, blob_paths)
+
+        calls = mock_container_client.delete_blobs.call_args_list
+        batches = sorted((call[0] for call in calls), key=len, reverse=True)
+        self.assertEqual([len(batch) for batch in batches], [256, 256, 188])
+        self.assertEqual(
+            mock_container_client.delete_blobs.call_args[1],
+            {'delete_snapshots': 'include', 'raise_on_any_failure': False})
+        # a failed batch request fails every blob in it
+        self.assertEqual(stats['deleted'], 256 + 255)
+        failed = sorted(stats['failed'], key=lambda item: item[1] or 0)
+        self.assertEqual(len(failed), 189)
+        self.assertEqual(failed[-1], ('blob7', 404, 'BlobNotFound'))
+        self.assertEqual(
+            {blob_path for blob_path, _, _ in failed[:-1]},
+            {f'blob{i}' for i in range(512, 700)})
+        self.assertEqual(
+            {(status, reason) for _, status, reason in failed[:-1]},
+            {(None, 'batch failed')})
+
+    def test_delete_directory(self):
+        blob_conn = self.get_blob_conn()
+        mock_container_client = (
+            blob_conn.blob_service_client.get_container_client.return_value)
+        mock_container_client.list_blobs.return_value = iter(
+            get_blob(f'data/{i}.json', '1') for i in range(3))
+        mock_container_client.delete_blobs.side_effect = (
+            lambda *blob_paths, **kwargs: [
+                Mock(status_code=202, reason='') for _ in blob_paths])
+
+        stats = blob_conn.delete_directory(container, 'data')
+        mock_container_client.list_blobs.assert_called_once_with(
+            name_starts_with='data/')
+        mock_container_client.delete_blobs.assert_called_once_with(
+            'data/0.json', 'data/1.json', 'data/2.json',
+            delete_snapshots='include', raise_on_any_failure=False)
+        self.assertEqual((stats['deleted'], stats['failed']), (3, []))
+
+    def test_read_range(self):
+        blob_conn = self.get_blob_conn()
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        mock_blob_client.download_blob.return_value.readall.return_value = (
+            b'footer')
+        self.assertEqual(
+            blob_conn.read_range(container, 'a.parquet', 10, 6), b'footer')
+        mock_blob_client.download_blob.assert_called_once_with(
+            offset=10, length=6)
+
+    def test_download_to_file(self):
+        blob_conn = self.get_blob_conn()
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        preallocated = []
+
+        def readinto(file):
+            preallocated.append(os.fstat(file.fileno()).st_size)
+            file.write(b'abcde')
+            return 5
+
+        mock_downloader = mock_blob_client.download_blob.return_value
+        mock_downloader.size = 5
+        mock_downloader.readinto.side_effect = readinto
+        file_path = os.path.join(tempfile.mkdtemp(), 'a.bin')
+        self.assertEqual(blob_conn.download_to_file(
+            container, 'a.bin', file_path, max_concurrency=4), 5)
+        self.assertEqual(preallocated, [5])
+        mock_blob_client.download_blob.assert_called_once_with(
+            max_concurrency=4)
+        mapped = blob_conn.download_to_file(
+            container, 'a.bin', file_path, as_mmap=True)
+        self.assertEqual(mapped[:], b'abcde')
+        mapped.close()
+
+        # an empty blob cannot be mapped
+        mock_downloader.size = 0
+        mock_downloader.readinto.side_effect = None
+        mock_downloader.readinto.return_value = 0
+        self.assertEqual(blob_conn.download_to_file(
+            container, 'empty.bin', file_path, as_mmap=True), b'')
+
+    def test_open_blob(self):
+        blob_conn = self.get_blob_conn()
+        mock_blob_client = (
+            blob_conn.blob_service_client.get_blob_client.return_value)
+        data = bytes(range(100))
+        mock_blob_client.get_blob_properties.return_value.size = len(data)
+        mock_blob_client.download_blob.side_effect = (
+            lambda offset, length: Mock(
+                readall=Mock(return_value=data[offset: offset + length])))
+        with blob_conn.open_blob(container, 'a.bin', block_size=16) as file:
+            file.seek(-10, os.SEEK_END)
+            self.assertEqual(file.read(), data[90:])
+            file.seek(20)
+            self.assertEqual(file.read(2), data[20:22])
+        calls = mock_blob_client.download_blob.call_args_list
+        self.assertEqual(
+            [call[1] for call in calls],
+            [{'offset': 90, 'length': 10}, {'offset': 20, 'length': 16}])
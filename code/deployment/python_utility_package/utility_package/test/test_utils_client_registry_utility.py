@@ -0,0 +1,81 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from utility_package.utils.client_registry_utility import (
+    ServiceClientRegistry)
+
+
+blob_conn_str = 'DefaultEndpointsProtocol=https;AccountName=testsa'
+account_url = 'https://testsa.dfs.core.windows.net/'
+spn_credentials = {
+    'tenant_id': 'tenant_id',
+    'spn_id': 'spn_id',
+    'spn_password': 'spn_password'
+}
+test_module_name = 'utility_package.utils.client_registry_utility'
+
+
+@patch(f'{test_module_name}.RequestsTransport')
+@patch(f'{test_module_name}.HTTPAdapter')
+class TestServiceClientRegistry(TestCase):
+    @patch(f'{test_module_name}.BlobServiceClient')
+    def test_get_blob_service_client(self, mock_blob_service_client, *_):
+        mock_from_connection_string = (
+            mock_blob_service_client.from_connection_string)
+        mock_from_connection_string.side_effect = (
+            lambda conn_str, **kwargs: object())
+        registry = ServiceClientRegistry()
+        client = registry.get_blob_service_client(blob_conn_str)
+        self.assertIs(registry.get_blob_service_client(blob_conn_str), client)
+        mock_from_connection_string.assert_called_once()
+        other_client = registry.get_blob_service_client(blob_conn_str + ';')
+        self.assertIsNot(other_client, client)
+
+    @patch(f'{test_module_name}.ClientSecretCredential')
+    @patch(f'{test_module_name}.DataLakeServiceClient')
+    def test_get_datalake_service_client(
+        self, mock_service_client, mock_credential, *_
+    ):
+        mock_service_client.side_effect = lambda **kwargs: object()
+        registry = ServiceClientRegistry()
+        client = registry.get_datalake_service_client(
+            account_url, spn_credentials)
+        self.assertIs(
+            registry.get_datalake_service_client(account_url, spn_credentials),
+            client)
+        mock_credential.assert_called_once_with(
+            'tenant_id', 'spn_id', 'spn_password')
+        # a different secret gets its own client
+        registry.get_datalake_service_client(
+            account_url, dict(spn_credentials, spn_password='changed'))
+        self.assertEqual(mock_service_client.call_count, 2)
+
+    def test_configure(self, mock_adapter, mock_transport):
+        registry = ServiceClientRegistry()
+        registry.configure(pool_maxsize=128)
+        registry.get_client('a', lambda transport: transport)
+        mock_adapter.assert_called_once_with(
+            pool_connections=10, pool_maxsize=128)
+        registry.configure(pool_connections=2)
+        registry.get_client('b', lambda transport: transport)
+        mock_adapter.assert_called_with(pool_connections=2, pool_maxsize=128)
+        session = mock_transport.call_args[1]['session']
+        for url in ['https://testsa', 'http://testsa']:
+            self.assertIs(
+                session.get_adapter(url), mock_adapter.return_value)
+        self.assertFalse(mock_transport.call_args[1]['session_owner'])
+
+    @patch(f'{test_module_name}.BlobServiceClient')
+    def test_close(self, mock_blob_service_client, mock_adapter, _):
+        mock_from_connection_string = (
+            mock_blob_service_client.from_connection_string)
+        registry = ServiceClientRegistry()
+        client = registry.get_blob_service_client(blob_conn_str)
+        registry.close()
+        client.close.assert_called_once()
+        # closing the session closes its mounted adapters
+        mock_adapter.return_value.close.assert_called()
+        mock_from_connection_string.return_value = 'new client'
+        self.assertEqual(
+            registry.get_blob_service_client(blob_conn_str), 'new client')
+        self.assertEqual(mock_from_connection_string.call_count, 2)
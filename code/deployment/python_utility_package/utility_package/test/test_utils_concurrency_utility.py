@@ -0,0 +1,49 @@
+import threading
+import time
+from unittest import TestCase
+
+from utility_package.utils.concurrency_utility import batched, imap_unordered
+
+
+class TestImapUnordered(TestCase):
+    def test_results_and_errors(self):
+        def func(item):
+            if item == 3:
+                raise ValueError('failed')
+            return item * 2
+
+        results = {
+            item: (result, error)
+            for item, result, error in imap_unordered(func, range(6), 2)
+        }
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[2], (4, None))
+        self.assertIsNone(results[3][0])
+        self.assertIsInstance(results[3][1], ValueError)
+
+    def test_bounded_pending(self):
+        submitted = []
+        lock = threading.Lock()
+
+        def items():
+            for item in range(100):
+                with lock:
+                    submitted.append(item)
+                yield item
+
+        def func(item):
+            time.sleep(0.001)
+            return item
+
+        results = imap_unordered(func, items(), max_workers=2)
+        next(results)
+        # at most 2 * max_workers calls are submitted ahead of the consumer
+        self.assertLessEqual(len(submitted), 5)
+        self.assertEqual(len(list(results)), 99)
+
+
+class TestBatched(TestCase):
+    def test_batched(self):
+        self.assertEqual(
+            list(batched(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(batched([], 2)), [])
@@ -1,9 +1,16 @@
+import asyncio
+import decimal
+import struct
+import time
 from unittest import TestCase
 from unittest.mock import patch, Mock
 
 import pandas as pd
 
-from utility_package.utils.db_utility import DBConnection
+from utility_package.utils.db_utility import (
+    ACCESS_TOKEN_CACHE, SQL_COPT_SS_ACCESS_TOKEN, AccessTokenCache,
+    DBConnection, DBConnectionPool, ResultCache, SQLException,
+    insert_data_in_parts)
 
 
 server_name = 'test-ss.database.windows.net'
@@ -29,18 +36,14 @@ class TestDBConnection(TestCase):
         self.assertEqual(dbobj.connection, mock_pyodbc_connection)
         self.assertTrue(mock_pyodbc_connection.autocommit)
 
-    @patch(f'{test_module_name}.adal')
+    @patch(f'{test_module_name}.ClientSecretCredential')
     @patch(f'{test_module_name}.pyodbc')
-    def test_init_spn_auth(self, mock_pyodbc, mock_adal):
-        token = {
-            'accessToken': 'abcdefgh'
-        }
+    def test_init_spn_auth(self, mock_pyodbc, mock_credential):
+        ACCESS_TOKEN_CACHE.clear()
+        token = Mock(token='abcdefgh', expires_on=time.time() + 3600)
         mock_pyodbc_connection = Mock()
         mock_pyodbc.connect.return_value = mock_pyodbc_connection
-        mock_adal_auth_context = Mock()
-        mock_adal_auth_context.acquire_token_with_client_credentials.\
-            return_value = token
-        mock_adal.AuthenticationContext.return_value = mock_adal_auth_context
+        mock_credential.return_value.get_token.return_value = token
         dbobj = DBConnection(
             server_name,
             db_name,
@@ -50,6 +53,17 @@ class TestDBConnection(TestCase):
             tenant_id=tenant_id
         )
         self.assertEqual(dbobj.connection, mock_pyodbc_connection)
+        mock_credential.return_value.get_token.assert_called_once_with(
+            'https://database.windows.net/.default')
+        token_bytes = 'abcdefgh'.encode('utf-16-le')
+        attrs_before = mock_pyodbc.connect.call_args[1]['attrs_before']
+        self.assertEqual(
+            attrs_before[SQL_COPT_SS_ACCESS_TOKEN],
+            struct.pack('<I', len(token_bytes)) + token_bytes
+        )
+        dbobj.refresh_connection()
+        mock_credential.return_value.get_token.assert_called_once()
+        self.assertEqual(mock_pyodbc.connect.call_count, 2)
 
     @patch(f'{test_module_name}.pyodbc')
     def test_run_sql_query_1(self, mock_pyodbc):
@@ -175,6 +189,38 @@ class TestDBConnection(TestCase):
         self.assertIsNone(results)
         self.assertIsNone(columns)
 
+    @patch(f'{test_module_name}.pyodbc')
+    def test_run_stored_proc_3(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = None
+
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd,
+            bind_params=True
+        )
+        params = {'param1': 'None of them', 'param2': None, 'param3': 3}
+        dbobj.run_stored_proc('dbo', 'demoSP', params=params)
+
+        stmt = "SET NOCOUNT ON;EXEC [dbo].[demoSP]"
+        stmt += "@param1=?,@param2=?,@param3=?;"
+        mock_pyodbc_cursor.execute.assert_called_once_with(
+            stmt, ['None of them', None, 3])
+
+    def test_form_stored_proc_stmt(self):
+        params = {'param1': "None of O'Brien's", 'param2': None}
+        stmt, values = DBConnection._form_stored_proc_stmt(
+            'dbo', 'demoSP', params)
+        req_stmt = "SET NOCOUNT ON;EXEC [dbo].[demoSP]"
+        req_stmt += "@param1='None of O''Brien''s',@param2=NULL;"
+        self.assertEqual(stmt, req_stmt)
+        self.assertEqual(values, [])
+
     @patch(f'{test_module_name}.pyodbc')
     def test_get_df_from_result_set_1(self, mock_pyodbc):
         dbobj = DBConnection(
@@ -213,6 +259,143 @@ class TestDBConnection(TestCase):
             )
         self.assertEqual(result_df.shape, (2, 2))
 
+    @patch(f'{test_module_name}.pyodbc')
+    def test_get_df_from_query_columnar_1(self, mock_pyodbc):
+        result_set = [
+            ('ID1', decimal.Decimal('1.5'), 1),
+            ('ID2', None, 2)
+        ]
+        columns_tuple = [
+            ('Col1', str), ('Col2', decimal.Decimal), ('Col3', int)]
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = columns_tuple
+        mock_pyodbc_cursor.fetchall.return_value = result_set
+
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd
+        )
+        result_df = dbobj.get_df_from_query('SELECT * FROM dbo.Table1')
+        self.assertEqual(list(result_df.columns), ['Col1', 'Col2', 'Col3'])
+        self.assertEqual(result_df['Col2'].dtype, float)
+        self.assertEqual(result_df['Col2'][0], 1.5)
+        self.assertTrue(pd.isnull(result_df['Col2'][1]))
+        self.assertEqual(list(result_df['Col3']), [1, 2])
+        mock_pyodbc_cursor.close.assert_called_once()
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_get_df_from_query_columnar_duplicate_columns(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [
+            ('id', int), ('id', decimal.Decimal), ('name', str)]
+        mock_pyodbc_cursor.fetchall.return_value = [
+            (1, decimal.Decimal('2.5'), 'a')]
+
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd
+        )
+        result_df = dbobj.get_df_from_query(
+            'SELECT a.id, b.id, a.name FROM a JOIN b ON a.x = b.x')
+        self.assertEqual(list(result_df.columns), ['id', 'id', 'name'])
+        self.assertEqual(list(result_df.iloc[0]), [1, 2.5, 'a'])
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_get_df_from_query_columnar_2(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [('Col1', str), ('Col2', int)]
+        mock_pyodbc_cursor.fetchall.return_value = []
+
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd
+        )
+        result_df = dbobj.get_df_from_query('SELECT * FROM dbo.Table1')
+        self.assertEqual(result_df.shape, (0, 2))
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_get_df_from_query_columnar_3(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = None
+
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd
+        )
+        result_df = dbobj.get_df_from_query('UPDATE dbo.Table1 SET Col1 = 1')
+        self.assertEqual(result_df.shape, (0, 0))
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_iter_query_chunks_1(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [('Col1', str), ('Col2', int)]
+        mock_pyodbc_cursor.fetchmany.side_effect = [
+            [('ID1', 1), ('ID2', 2)],
+            [('ID3', 3)],
+            []
+        ]
+
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd
+        )
+        chunks = list(dbobj.iter_query_chunks(
+            'SELECT * FROM dbo.Table1', chunk_rows=2))
+        self.assertEqual([chunk.shape for chunk in chunks], [(2, 2), (1, 2)])
+        mock_pyodbc_cursor.fetchmany.assert_called_with(2)
+        mock_pyodbc_cursor.close.assert_called_once()
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_iter_query_chunks_2(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [('Col1', str), ('Col2', int)]
+        mock_pyodbc_cursor.fetchmany.side_effect = [
+            [('ID1', 1), ('ID2', 2)],
+            [('ID3', 3)],
+            []
+        ]
+
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd
+        )
+        chunks = dbobj.iter_stored_proc_chunks(
+            'dbo', 'demoSP', chunk_rows=2, as_df=False)
+        self.assertEqual(next(chunks), [('ID1', 1), ('ID2', 2)])
+        mock_pyodbc_cursor.close.assert_not_called()
+        chunks.close()
+        mock_pyodbc_cursor.close.assert_called_once()
+
     def test_format_result_set(self):
         results = [('ID1', 1), ('ID2', 2)]
         columns = ['col1', 'col2']
@@ -269,6 +452,28 @@ class TestDBConnection(TestCase):
         )
         self.assertIsNone(result_query)
 
+    def test_form_query_from_df_3(self):
+        input_df = pd.DataFrame({
+            'NAME': ["O'Brien", 'Smith'],
+            'QTY': [1.5, None],
+            'LOAD_DATE': pd.to_datetime(
+                ['2021-01-01 00:00:00', '2021-01-02 10:30:00'])
+        })
+        req_query = "DECLARE @InputVar [dbo].[TableType] "
+        req_query += "INSERT INTO @InputVar "
+        req_query += "([NAME],[QTY],[LOAD_DATE]) "
+        req_query += "SELECT 'O''Brien',1.5,'2021-01-01 00:00:00' UNION ALL "
+        req_query += "SELECT 'Smith',NULL,'2021-01-02 10:30:00';"
+        req_query += "EXEC [dbo].[uspInsert] @InputVar"
+
+        result_query = DBConnection.form_query_from_df(
+            'dbo',
+            'uspInsert',
+            input_df,
+            'TableType'
+        )
+        self.assertEqual(req_query, result_query)
+
     @patch(f'{test_module_name}.pyodbc')
     def test_insert_data_from_df(self, mock_pyodbc):
         dbobj = DBConnection(
@@ -297,3 +502,436 @@ class TestDBConnection(TestCase):
             'test_table_type_name'
         )
         mock_run_sql_query.assert_called_once()
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_insert_data_from_df_bulk(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd
+        )
+        mock_form_query_from_df = Mock()
+        dbobj.form_query_from_df = mock_form_query_from_df
+
+        test_input_df = pd.DataFrame({'a': [1, None], 'b': ['x', 'y']})
+        dbobj.insert_data_from_df(
+            schema='test_schema',
+            sp_name='test_sp_name',
+            input_df=test_input_df,
+            table_type_name='test_table_type_name',
+            bulk=True
+        )
+
+        mock_form_query_from_df.assert_not_called()
+        self.assertTrue(mock_pyodbc_cursor.fast_executemany)
+        insert_stmt, rows = mock_pyodbc_cursor.executemany.call_args[0]
+        self.assertEqual(
+            insert_stmt,
+            "INSERT INTO #InputVarStaging ([a],[b]) VALUES (?,?)"
+        )
+        self.assertEqual(rows, [(1.0, 'x'), (None, 'y')])
+        exec_stmt = mock_pyodbc_cursor.execute.call_args[0][0]
+        self.assertTrue(
+            exec_stmt.endswith("EXEC [test_schema].[test_sp_name] @InputVar;")
+        )
+
+
+class TestDBConnectionPool(TestCase):
+    @patch(f'{test_module_name}.pyodbc')
+    def test_checkout_reuses_connection(self, mock_pyodbc):
+        mock_pyodbc.connect.side_effect = lambda connstring: Mock()
+        pool = DBConnectionPool(
+            server_name,
+            db_name,
+            user_name,
+            pwd,
+            min_size=1,
+            max_size=2
+        )
+        self.assertEqual(mock_pyodbc.connect.call_count, 1)
+        dbobj_1 = pool.checkout()
+        dbobj_2 = pool.checkout()
+        self.assertIsNot(dbobj_1, dbobj_2)
+        self.assertEqual(mock_pyodbc.connect.call_count, 2)
+        with self.assertRaises(SQLException):
+            pool.checkout(timeout=0)
+        pool.checkin(dbobj_1)
+        self.assertIs(pool.checkout(), dbobj_1)
+        self.assertEqual(mock_pyodbc.connect.call_count, 2)
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_checkout_evicts_expired(self, mock_pyodbc):
+        mock_pyodbc.connect.side_effect = lambda connstring: Mock()
+        pool = DBConnectionPool(
+            server_name,
+            db_name,
+            user_name,
+            pwd,
+            min_size=1,
+            max_lifetime=0
+        )
+        dbobj_1 = pool.checkout()
+        pool.checkin(dbobj_1)
+        dbobj_2 = pool.checkout()
+        self.assertIsNot(dbobj_1, dbobj_2)
+        self.assertIsNone(dbobj_1.connection)
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_checkout_probes_idle_connection(self, mock_pyodbc):
+        mock_pyodbc.Error = Exception
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        pool = DBConnectionPool(
+            server_name,
+            db_name,
+            user_name,
+            pwd,
+            health_check_interval=0
+        )
+        mock_pyodbc_connection.cursor.return_value.execute.side_effect = \
+            Exception('Communication link failure')
+        pool.checkout()
+        self.assertEqual(mock_pyodbc.connect.call_count, 2)
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_checkout_closes_failed_connection(self, mock_pyodbc):
+        mock_pyodbc.Error = Exception
+        mock_pyodbc.connect.side_effect = lambda connstring: Mock()
+        pool = DBConnectionPool(
+            server_name,
+            db_name,
+            user_name,
+            pwd,
+            health_check_interval=0
+        )
+        dbobj = pool.checkout()
+        broken_connections = []
+        for close_error in [None, Exception('Connection is busy')]:
+            broken_connection = dbobj.connection
+            broken_connection.cursor.return_value.execute.side_effect = \
+                Exception('Communication link failure')
+            broken_connection.close.side_effect = close_error
+            broken_connections.append(broken_connection)
+            pool.checkin(dbobj)
+            self.assertIs(pool.checkout(), dbobj)
+            broken_connection.close.assert_called_once()
+            self.assertNotIn(dbobj.connection, broken_connections)
+        self.assertEqual(mock_pyodbc.connect.call_count, 3)
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_run_sql_query(self, mock_pyodbc):
+        result_set = [('ID1', 1)]
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [('Col1', 1), ('Col2', 2)]
+        mock_pyodbc_cursor.fetchall.return_value = result_set
+
+        pool = DBConnectionPool(server_name, db_name, user_name, pwd)
+        results, columns = pool.run_sql_query('SELECT * FROM dbo.Table1')
+        self.assertEqual(results, result_set)
+        self.assertEqual(columns, ['Col1', 'Col2'])
+        self.assertEqual(len(pool._idle), 1)
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_run_many(self, mock_pyodbc):
+        def connect(connstring):
+            mock_pyodbc_connection = Mock()
+            mock_pyodbc_cursor = Mock()
+            mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+
+            def execute(query):
+                mock_pyodbc_cursor.description = [('Query', str)]
+                mock_pyodbc_cursor.fetchall.return_value = [(query,)]
+            mock_pyodbc_cursor.execute.side_effect = execute
+            return mock_pyodbc_connection
+        mock_pyodbc.connect.side_effect = connect
+
+        pool = DBConnectionPool(
+            server_name, db_name, user_name, pwd, max_size=3)
+        queries = [f'SELECT {i}' for i in range(6)]
+        queries.append(('dbo', 'demoSP', {'param1': 'value1'}))
+        results = asyncio.run(pool.run_many(queries, timeout=5))
+        self.assertEqual(
+            [result_df['Query'][0] for result_df in results],
+            queries[:6] + [
+                "SET NOCOUNT ON;EXEC [dbo].[demoSP]@param1='value1';"]
+        )
+        self.assertLessEqual(mock_pyodbc.connect.call_count, 3)
+        pool.close()
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_get_df_async_timeout(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.execute.side_effect = \
+            lambda query: time.sleep(0.5)
+
+        pool = DBConnectionPool(server_name, db_name, user_name, pwd)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(pool.get_df_async('SELECT 1', timeout=0.05))
+        pool.close()
+
+
+class TestAccessTokenCache(TestCase):
+    @patch(f'{test_module_name}.ClientSecretCredential')
+    def test_get_token_refresh(self, mock_credential):
+        mock_get_token = mock_credential.return_value.get_token
+        mock_get_token.side_effect = [
+            Mock(token='token1', expires_on=time.time() + 300),
+            Mock(token='token2', expires_on=time.time() + 3600),
+            Mock(token='token3', expires_on=time.time() + 3600)
+        ]
+        cache = AccessTokenCache(refresh_margin=600, min_validity=60)
+        args = (tenant_id, user_name, pwd, 'https://database.windows.net/')
+        # within refresh_margin: served while refreshed in the background
+        self.assertEqual(cache.get_token(*args), 'token1')
+        for _ in range(100):
+            token = cache.get_token(*args)
+            if token == 'token2':
+                break
+            time.sleep(0.01)
+        self.assertEqual(token, 'token2')
+        self.assertEqual(mock_get_token.call_count, 2)
+        cache.clear()
+        self.assertEqual(cache.get_token(*args), 'token3')
+
+    @patch(f'{test_module_name}.ClientSecretCredential')
+    def test_get_token_authority(self, mock_credential):
+        mock_credential.return_value.get_token.return_value = Mock(
+            token='token1', expires_on=time.time() + 3600)
+        cache = AccessTokenCache()
+        resource_uri = 'https://database.windows.net/'
+        cache.get_token(tenant_id, user_name, pwd, resource_uri)
+        cache.get_token(
+            tenant_id, user_name, pwd, resource_uri,
+            'login.microsoftonline.us')
+        self.assertEqual(
+            [call[1]['authority'] for call in mock_credential.call_args_list],
+            ['login.microsoftonline.com', 'login.microsoftonline.us'])
+
+    @patch(f'{test_module_name}.ClientSecretCredential')
+    def test_get_token_secret_changed(self, mock_credential):
+        mock_get_token = mock_credential.return_value.get_token
+        mock_get_token.side_effect = [
+            Mock(token='token1', expires_on=time.time() + 3600),
+            Mock(token='token2', expires_on=time.time() + 3600)
+        ]
+        cache = AccessTokenCache()
+        resource_uri = 'https://database.windows.net/'
+        for _ in range(2):
+            self.assertEqual(
+                cache.get_token(tenant_id, user_name, pwd, resource_uri),
+                'token1')
+        # a rotated secret gets a new credential and token
+        self.assertEqual(
+            cache.get_token(tenant_id, user_name, 'new_pwd', resource_uri),
+            'token2')
+        self.assertEqual(mock_credential.call_count, 2)
+
+
+class TestResultCache(TestCase):
+    def test_query_key(self):
+        self.assertEqual(
+            ResultCache.query_key("SELECT *\n  FROM t WHERE a = 'x  y' "),
+            ResultCache.query_key("SELECT * FROM t WHERE a = 'x  y'")
+        )
+        self.assertNotEqual(
+            ResultCache.query_key("SELECT * FROM t WHERE a = 'x  y'"),
+            ResultCache.query_key("SELECT * FROM t WHERE a = 'x y'")
+        )
+
+    def test_get_returns_copy(self):
+        cache = ResultCache()
+        cache.put('key', pd.DataFrame({'a': [1, 2]}))
+        result_df = cache.get('key')
+        result_df['a'] = 0
+        self.assertEqual(list(cache.get('key')['a']), [1, 2])
+        self.assertIsNone(cache.get('other'))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_lru_and_ttl(self):
+        cache = ResultCache(max_entries=2)
+        cache.put('key1', pd.DataFrame({'a': [1]}))
+        cache.put('key2', pd.DataFrame({'a': [2]}))
+        cache.get('key1')
+        cache.put('key3', pd.DataFrame({'a': [3]}))
+        self.assertIsNone(cache.get('key2'))
+        self.assertIsNotNone(cache.get('key1'))
+        expired_cache = ResultCache(ttl=-1)
+        expired_cache.put('key1', pd.DataFrame({'a': [1]}))
+        self.assertIsNone(expired_cache.get('key1'))
+
+    def test_invalidate_stored_proc(self):
+        cache = ResultCache()
+        cache.put(
+            ResultCache.stored_proc_key('dbo', 'demoSP', {'p': 1}),
+            pd.DataFrame())
+        cache.put(ResultCache.query_key('SELECT 1'), pd.DataFrame())
+        cache.invalidate_stored_proc('DBO', 'demoSP')
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_invalidate_stored_proc_database(self):
+        cache = ResultCache()
+        for database in [('s1', 'db'), ('s2', 'db')]:
+            cache.put(
+                ResultCache.stored_proc_key(
+                    'dbo', 'demoSP', {'p': 1}, database),
+                pd.DataFrame())
+        cache.invalidate_stored_proc('dbo', 'demoSP', ('s1', 'db'))
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertIsNotNone(cache.get(ResultCache.stored_proc_key(
+            'dbo', 'demoSP', {'p': 1}, ('s2', 'db'))))
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_shared_cache_scoped_to_database(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [('Col1', str)]
+        mock_pyodbc_cursor.fetchall.side_effect = [[('db1',)], [('db2',)]]
+
+        result_cache = ResultCache()
+        dbobj1 = DBConnection(
+            server_name, 'db1', user_name, pwd, result_cache=result_cache)
+        dbobj2 = DBConnection(
+            server_name, 'db2', user_name, pwd, result_cache=result_cache)
+        result_df1 = dbobj1.get_df_from_query('SELECT 1', use_cache=True)
+        result_df2 = dbobj2.get_df_from_query('SELECT 1', use_cache=True)
+        self.assertEqual(list(result_df1['Col1']), ['db1'])
+        self.assertEqual(list(result_df2['Col1']), ['db2'])
+        self.assertEqual(mock_pyodbc_cursor.execute.call_count, 2)
+        self.assertEqual(
+            list(dbobj1.get_df_from_query('SELECT 1', use_cache=True)['Col1']),
+            ['db1'])
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_get_df_from_stored_proc_cached(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [('Col1', str)]
+        mock_pyodbc_cursor.fetchall.return_value = [('ID1',)]
+
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd,
+            result_cache=ResultCache()
+        )
+        for _ in range(3):
+            result_df = dbobj.get_df_from_stored_proc(
+                'dbo', 'demoSP', {'param1': 'value1'}, use_cache=True)
+        self.assertEqual(list(result_df['Col1']), ['ID1'])
+        mock_pyodbc_cursor.execute.assert_called_once()
+        dbobj.get_df_from_stored_proc('dbo', 'demoSP', {'param1': 'value1'})
+        self.assertEqual(mock_pyodbc_cursor.execute.call_count, 2)
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_get_df_not_cached_by_default(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [('Col1', str)]
+        mock_pyodbc_cursor.fetchall.return_value = [('ID1',)]
+
+        result_cache = ResultCache()
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd,
+            result_cache=result_cache
+        )
+        # writes run every time unless the caller opts in to the cache
+        for _ in range(2):
+            dbobj.get_df_from_query('UPDATE t SET a = 1; SELECT 1')
+            dbobj.get_df_from_stored_proc('dbo', 'writeSP')
+        self.assertEqual(mock_pyodbc_cursor.execute.call_count, 4)
+        pool = DBConnectionPool(
+            server_name, db_name, user_name, pwd, result_cache=result_cache)
+        pool.get_df_from_query('UPDATE t SET a = 1; SELECT 1')
+        pool.get_df_from_stored_proc('dbo', 'writeSP')
+        pool.close()
+        self.assertEqual(mock_pyodbc_cursor.execute.call_count, 6)
+        self.assertEqual(result_cache.stats()['entries'], 0)
+
+    @patch(f'{test_module_name}.pyodbc')
+    def test_get_result_df_from_input_df_not_cached(self, mock_pyodbc):
+        mock_pyodbc_connection = Mock()
+        mock_pyodbc.connect.return_value = mock_pyodbc_connection
+        mock_pyodbc_cursor = Mock()
+        mock_pyodbc_connection.cursor.return_value = mock_pyodbc_cursor
+        mock_pyodbc_cursor.description = [('Col1', str)]
+        mock_pyodbc_cursor.fetchall.return_value = [('ID1',)]
+        input_df = pd.DataFrame({'a': ['1']})
+
+        result_cache = ResultCache()
+        dbobj = DBConnection(
+            server_name,
+            db_name,
+            user_name,
+            pwd,
+            result_cache=result_cache
+        )
+        for _ in range(3):
+            dbobj.get_result_df_from_input_df(
+                'dbo', 'demoSP', input_df, 'TableType_Demo')
+        self.assertEqual(mock_pyodbc_cursor.execute.call_count, 3)
+        pool = DBConnectionPool(
+            server_name, db_name, user_name, pwd, result_cache=result_cache)
+        for _ in range(2):
+            pool.get_result_df_from_input_df(
+                'dbo', 'demoSP', input_df, 'TableType_Demo')
+        pool.close()
+        self.assertEqual(mock_pyodbc_cursor.execute.call_count, 5)
+        self.assertEqual(result_cache.stats()['entries'], 0)
+
+
+class TestInsertDataInParts(TestCase):
+    def test_insert_data_in_parts_small_df(self):
+        dbobj = Mock()
+        test_input_df = pd.DataFrame({'a': [1, 2, 3], 'b': [4, 5, 6]})
+        batches = insert_data_in_parts(
+            dbobj, 'test_schema', 'test_sp_name', test_input_df,
+            'test_table_type_name')
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0]['rows'], 3)
+        dbobj.insert_data_from_df.assert_called_once()
+
+    def test_insert_data_in_parts_batch_bytes(self):
+        dbobj = Mock()
+        test_input_df = pd.DataFrame({'a': range(10), 'b': range(10)})
+        batches = insert_data_in_parts(
+            dbobj, 'test_schema', 'test_sp_name', test_input_df,
+            'test_table_type_name', max_batch_bytes=64)
+        self.assertEqual(
+            [(batch['start'], batch['end']) for batch in batches],
+            [(0, 4), (4, 8), (8, 10)]
+        )
+        self.assertEqual(dbobj.insert_data_from_df.call_count, 3)
+
+    def test_insert_data_in_parts_parallel(self):
+        dbobj = Mock(spec=DBConnectionPool)
+        test_input_df = pd.DataFrame({'a': range(10), 'b': range(10)})
+        batches = insert_data_in_parts(
+            dbobj, 'test_schema', 'test_sp_name', test_input_df,
+            'test_table_type_name', bulk=True, max_batch_rows=3,
+            max_workers=4)
+        self.assertEqual([batch['batch'] for batch in batches], [1, 2, 3, 4])
+        self.assertEqual(sum(batch['rows'] for batch in batches), 10)
+        self.assertEqual(dbobj.insert_data_from_df.call_count, 4)
+        dbobj.close.assert_not_called()
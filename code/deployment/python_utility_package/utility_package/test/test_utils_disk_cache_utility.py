@@ -0,0 +1,97 @@
+from io import BytesIO
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError, ResourceNotFoundError, ResourceNotModifiedError)
+
+from utility_package.utils.disk_cache_utility import CachedDownload, DiskCache
+
+
+def get_downloader(data, etag):
+    downloader = Mock()
+    downloader.readall.return_value = data
+    downloader.properties.etag = etag
+    return downloader
+
+
+class TestDiskCache(TestCase):
+    def setUp(self):
+        self.cache = DiskCache(tempfile.mkdtemp())
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.put('key', '"etag1"', b'data\nwith newline')
+        self.assertEqual(
+            self.cache.get('key'), ('"etag1"', b'data\nwith newline'))
+
+    def test_read_through_revalidates(self):
+        download = Mock(return_value=get_downloader(b'data', '"etag1"'))
+        cached = self.cache.read_through('key', download, 'a/b.json')
+        download.assert_called_once_with()
+        self.assertEqual(cached.readall(), b'data')
+        self.assertEqual(cached.properties.etag, '"etag1"')
+
+        # 304: the local copy is served
+        download = Mock(side_effect=ResourceNotModifiedError('not modified'))
+        cached = self.cache.read_through('key', download, 'a/b.json')
+        download.assert_called_once_with(
+            etag='"etag1"', match_condition=MatchConditions.IfModified)
+        self.assertEqual(cached.readall(), b'data')
+        self.assertEqual(cached.name, 'a/b.json')
+        self.assertEqual(cached.properties.etag, '"etag1"')
+
+        # changed content replaces the entry
+        download = Mock(return_value=get_downloader(b'new data', '"etag2"'))
+        cached = self.cache.read_through('key', download)
+        self.assertEqual(cached.readall(), b'new data')
+        self.assertEqual(self.cache.get('key'), ('"etag2"', b'new data'))
+
+    def test_read_through_http_304(self):
+        # older SDKs raise a plain HttpResponseError for 304
+        self.cache.put('key', '"etag1"', b'data')
+        response = Mock(status_code=304, reason='Not Modified')
+        download = Mock(side_effect=HttpResponseError(response=response))
+        cached = self.cache.read_through('key', download)
+        self.assertEqual(cached.readall(), b'data')
+        self.assertEqual(cached.properties.etag, '"etag1"')
+        download = Mock(side_effect=ResourceNotFoundError('not found'))
+        with self.assertRaises(ResourceNotFoundError):
+            self.cache.read_through('key', download)
+
+    def test_lru_eviction(self):
+        # entries are 100 bytes of data plus a json header line
+        cache = DiskCache(self.cache.cache_dir, max_bytes=300)
+        for i, key in enumerate(['key1', 'key2', 'key3']):
+            cache.put(key, 'etag', b'x' * 100)
+            mtime = 1000 + i
+            os.utime(cache._get_path(key), (mtime, mtime))
+        # only two entries fit, the least recently read one is evicted
+        self.assertIsNone(cache.get('key1'))
+        self.assertIsNotNone(cache.get('key2'))
+        os.utime(cache._get_path('key3'), (1000, 1000))
+        cache.put('key4', 'etag', b'x' * 100)
+        self.assertIsNone(cache.get('key3'))
+        self.assertIsNotNone(cache.get('key2'))
+        self.assertIsNotNone(cache.get('key4'))
+
+
+class TestCachedDownload(TestCase):
+    def test_cached_download(self):
+        cached = CachedDownload(
+            'café'.encode('utf-8'), '"etag"', 'a.txt', chunk_size=2)
+        self.assertEqual(cached.name, 'a.txt')
+        self.assertEqual(cached.size, 5)
+        self.assertEqual(cached.properties.name, 'a.txt')
+        self.assertEqual(cached.properties.etag, '"etag"')
+        self.assertEqual(cached.properties.size, 5)
+        self.assertEqual(cached.content_as_text(), 'café')
+        self.assertEqual(
+            cached.content_as_bytes(max_concurrency=4), b'caf\xc3\xa9')
+        self.assertEqual(list(cached.chunks()), [b'ca', b'f\xc3', b'\xa9'])
+        buffer = BytesIO()
+        self.assertEqual(cached.readinto(buffer), 5)
+        self.assertEqual(buffer.getvalue(), cached.readall())
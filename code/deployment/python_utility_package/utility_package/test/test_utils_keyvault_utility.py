@@ -0,0 +1,138 @@
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch, Mock
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from utility_package.utils.keyvault_utility import (
+    KeyvaultSecretsUtility, SECRET_CACHE)
+
+
+kv_name = 'test-kv'
+spn_credentials = {
+    'tenant_id': 'tenant_id',
+    'spn_id': 'spn_id',
+    'spn_password': 'spn_password'
+}
+test_module_name = 'utility_package.utils.keyvault_utility'
+
+
+def get_secret(name, value):
+    secret = Mock(value=value)
+    secret.name = name
+    return secret
+
+
+class TestKeyvaultSecretsUtility(TestCase):
+    def setUp(self):
+        SECRET_CACHE.invalidate()
+
+    @patch(f'{test_module_name}.ClientSecretCredential')
+    @patch(f'{test_module_name}.SecretClient')
+    def get_kv_client(self, mock_secret_client, _, **kwargs):
+        kv_client = KeyvaultSecretsUtility(spn_credentials, kv_name, **kwargs)
+        self.assertEqual(kv_client.client, mock_secret_client.return_value)
+        return kv_client
+
+    def test_get_secret_without_cache(self):
+        kv_client = self.get_kv_client()
+        kv_client.client.get_secret.return_value = get_secret('s1', 'v1')
+        for _ in range(2):
+            self.assertEqual(kv_client.get_secret('s1'), ('s1', 'v1'))
+        self.assertEqual(kv_client.client.get_secret.call_count, 2)
+
+    def test_get_secret_not_found(self):
+        kv_client = self.get_kv_client(cache_ttl=300)
+        kv_client.client.get_secret.side_effect = ResourceNotFoundError('nf')
+        with self.assertRaises(ResourceNotFoundError):
+            kv_client.get_secret('s1')
+
+    def test_get_secret_ttl(self):
+        kv_client = self.get_kv_client(cache_ttl=300)
+        kv_client.client.get_secret.side_effect = [
+            get_secret('s1', 'v1'), get_secret('s1', 'v2'),
+            get_secret('s1', 'v3')]
+        for _ in range(3):
+            self.assertEqual(kv_client.get_secret('s1'), ('s1', 'v1'))
+        kv_client.client.get_secret.assert_called_once_with('s1')
+        # an expired secret is fetched again while the caller waits
+        with patch(
+            'utility_package.utils.refresh_cache_utility.time.time',
+            return_value=time.time() + 301
+        ):
+            self.assertEqual(kv_client.get_secret('s1'), ('s1', 'v2'))
+        kv_client.clear_cache()
+        self.assertEqual(kv_client.get_secret('s1'), ('s1', 'v3'))
+
+    def test_get_secret_background_refresh(self):
+        kv_client = self.get_kv_client(cache_ttl=300, refresh_margin=300)
+        refreshed = threading.Event()
+
+        def fetch_secret(name):
+            if kv_client.client.get_secret.call_count > 1:
+                refreshed.set()
+                return get_secret(name, 'v2')
+            return get_secret(name, 'v1')
+
+        kv_client.client.get_secret.side_effect = fetch_secret
+        self.assertEqual(kv_client.get_secret('s1'), ('s1', 'v1'))
+        # within refresh_margin: served while refreshed in the background
+        self.assertEqual(kv_client.get_secret('s1'), ('s1', 'v1'))
+        self.assertTrue(refreshed.wait(5))
+        for _ in range(100):
+            secret = kv_client.get_secret('s1')
+            if secret == ('s1', 'v2'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(secret, ('s1', 'v2'))
+
+    def test_get_secrets(self):
+        kv_client = self.get_kv_client(cache_ttl=300)
+        kv_client.client.get_secret.side_effect = (
+            lambda name: get_secret(name, name.upper()))
+        self.assertEqual(
+            kv_client.get_secrets(['s1', 's2', 's1']),
+            {'s1': 'S1', 's2': 'S2'})
+        self.assertEqual(kv_client.client.get_secret.call_count, 2)
+        kv_client.get_secrets(['s1', 's2'])
+        self.assertEqual(kv_client.client.get_secret.call_count, 2)
+
+    def test_get_secrets_errors(self):
+        kv_client = self.get_kv_client()
+        fetched = []
+
+        def fetch_secret(name):
+            fetched.append(name)
+            if name == 'missing':
+                raise ResourceNotFoundError('nf')
+            return get_secret(name, 'value')
+
+        kv_client.client.get_secret.side_effect = fetch_secret
+        with self.assertRaises(ResourceNotFoundError):
+            kv_client.get_secrets(['s1', 'missing', 's2'])
+        # one failure does not stop the other fetches
+        self.assertEqual(sorted(fetched), ['missing', 's1', 's2'])
+
+    def test_cache_shared_per_vault(self):
+        kv_client_1 = self.get_kv_client(cache_ttl=300)
+        kv_client_2 = self.get_kv_client(cache_ttl=300)
+        other_kv_client = self.get_kv_client(cache_ttl=300)
+        other_kv_client.url = 'https://other-kv.vault.azure.net/'
+        for kv_client, value in [
+            (kv_client_1, 'v1'), (kv_client_2, 'v2'), (other_kv_client, 'o1')
+        ]:
+            kv_client.client.get_secret.return_value = get_secret('s1', value)
+
+        self.assertEqual(kv_client_1.get_secret('s1'), ('s1', 'v1'))
+        # a new instance for the same vault reuses the fetched secret
+        self.assertEqual(kv_client_2.get_secret('s1'), ('s1', 'v1'))
+        kv_client_2.client.get_secret.assert_not_called()
+        self.assertEqual(other_kv_client.get_secret('s1'), ('s1', 'o1'))
+
+        # clear_cache only drops the secrets of its own vault
+        other_kv_client.client.get_secret.return_value = get_secret(
+            's1', 'o2')
+        kv_client_2.clear_cache()
+        self.assertEqual(kv_client_2.get_secret('s1'), ('s1', 'v2'))
+        self.assertEqual(other_kv_client.get_secret('s1'), ('s1', 'o1'))
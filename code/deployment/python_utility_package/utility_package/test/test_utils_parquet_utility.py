@@ -0,0 +1,65 @@
+from io import BytesIO
+from unittest import TestCase
+
+import pandas as pd
+
+from utility_package.utils.parquet_utility import read_parquet, write_parquet
+from utility_package.utils.stream_utility import open_range_reader
+
+
+def get_parquet(input_df, row_group_size=None):
+    buffer = BytesIO()
+    write_parquet(input_df, buffer, row_group_size=row_group_size)
+    return buffer.getvalue()
+
+
+class TestParquet(TestCase):
+    def setUp(self):
+        self.input_df = pd.DataFrame({
+            'a': range(100),
+            'b': [f'name{i}' for i in range(100)],
+            'c': [i / 2 for i in range(100)]
+        })
+        self.data = get_parquet(self.input_df, row_group_size=10)
+        self.ranges = []
+
+    def open_file(self):
+        def read_range(offset, length):
+            self.ranges.append((offset, length))
+            return self.data[offset: offset + length]
+
+        return open_range_reader(read_range, len(self.data), block_size=64)
+
+    def test_round_trip(self):
+        result_df = read_parquet(self.open_file())
+        pd.testing.assert_frame_equal(result_df, self.input_df)
+
+    def test_columns_and_row_groups(self):
+        result_df = read_parquet(
+            self.open_file(), columns=['c', 'a'], row_groups=[2])
+        self.assertEqual(list(result_df.columns), ['c', 'a'])
+        self.assertEqual(list(result_df['a']), list(range(20, 30)))
+
+    def test_filters(self):
+        result_df = read_parquet(
+            self.open_file(), columns=['b'],
+            filters=[('a', '>=', 95), ('c', '!=', 48.0)])
+        self.assertEqual(list(result_df.columns), ['b'])
+        self.assertEqual(
+            list(result_df['b']), ['name95', 'name97', 'name98', 'name99'])
+        result_df = read_parquet(
+            self.open_file(), filters=[('a', 'in', [5, 50]), ('b', '<', 'z')])
+        self.assertEqual(list(result_df['a']), [5, 50])
+
+    def test_filters_prune_row_groups(self):
+        read_parquet(self.open_file(), filters=[('a', '==', 99)])
+        pruned_bytes = sum(length for _, length in self.ranges)
+        self.ranges = []
+        read_parquet(self.open_file())
+        self.assertLess(pruned_bytes, sum(length for _, length in self.ranges))
+
+    def test_filters_no_match(self):
+        result_df = read_parquet(
+            self.open_file(), columns=['a', 'b'], filters=[('a', '<', 0)])
+        self.assertEqual(len(result_df), 0)
+        self.assertEqual(list(result_df.columns), ['a', 'b'])
@@ -0,0 +1,80 @@
+import io
+import mmap
+import os
+import tempfile
+from unittest import TestCase
+
+from utility_package.utils.stream_utility import (
+    RangeReader, open_range_reader, open_read_only_mmap)
+
+
+data = bytes(range(100))
+
+
+class TestRangeReader(TestCase):
+    def setUp(self):
+        self.ranges = []
+
+    def read_range(self, offset, length):
+        self.ranges.append((offset, length))
+        return data[offset: offset + length]
+
+    def test_read_and_seek(self):
+        reader = RangeReader(self.read_range, len(data))
+        self.assertTrue(reader.readable())
+        self.assertTrue(reader.seekable())
+        self.assertEqual(reader.read(10), data[:10])
+        self.assertEqual(reader.tell(), 10)
+        self.assertEqual(reader.seek(-5, io.SEEK_END), 95)
+        self.assertEqual(reader.read(), data[95:])
+        self.assertEqual(reader.seek(-50, io.SEEK_CUR), 50)
+        self.assertEqual(reader.read(3), data[50:53])
+        self.assertEqual(self.ranges, [(0, 10), (95, 5), (50, 3)])
+
+    def test_read_past_end(self):
+        reader = RangeReader(self.read_range, len(data))
+        reader.seek(200)
+        self.assertEqual(reader.read(10), b'')
+        self.assertEqual(reader.readinto(bytearray(10)), 0)
+        # nothing is requested beyond the end of the file
+        self.assertEqual(self.ranges, [])
+        reader.seek(98)
+        self.assertEqual(reader.read(10), data[98:])
+        self.assertEqual(self.ranges, [(98, 2)])
+
+    def test_invalid_seek(self):
+        reader = RangeReader(self.read_range, len(data))
+        with self.assertRaises(ValueError):
+            reader.seek(-1)
+        with self.assertRaises(ValueError):
+            reader.seek(0, 3)
+        self.assertEqual(reader.tell(), 0)
+
+    def test_open_range_reader(self):
+        reader = open_range_reader(self.read_range, len(data), block_size=32)
+        self.assertEqual(reader.read(4), data[:4])
+        self.assertEqual(reader.read(4), data[4:8])
+        # small reads are served from one block sized request
+        self.assertEqual(self.ranges, [(0, 32)])
+        reader.seek(90)
+        self.assertEqual(reader.read(), data[90:])
+        self.assertEqual(self.ranges[1:], [(90, 10)])
+
+
+class TestOpenReadOnlyMmap(TestCase):
+    def get_file_path(self, content):
+        file_path = os.path.join(tempfile.mkdtemp(), 'data.bin')
+        with open(file_path, 'wb') as file:
+            file.write(content)
+        return file_path
+
+    def test_mmap(self):
+        mapped = open_read_only_mmap(self.get_file_path(data))
+        self.assertIsInstance(mapped, mmap.mmap)
+        self.assertEqual(mapped[:], data)
+        with self.assertRaises(TypeError):
+            mapped[0] = 1
+        mapped.close()
+
+    def test_empty_file(self):
+        self.assertEqual(open_read_only_mmap(self.get_file_path(b'')), b'')
@@ -1,8 +1,189 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timezone
 from io import BytesIO
+import os
+import posixpath
+import tempfile
+import time
+import uuid
 
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import ClientSecretCredential
 from azure.storage.filedatalake import DataLakeServiceClient
 
+from utility_package.utils.client_registry_utility import (
+    SERVICE_CLIENT_REGISTRY)
+from utility_package.utils.concurrency_utility import imap_unordered
+from utility_package.utils.disk_cache_utility import CachedDownload
+from utility_package.utils.manifest_utility import ChangeTracker
+from utility_package.utils.parquet_utility import read_parquet, write_parquet
+from utility_package.utils.stream_utility import (
+    open_range_reader, open_read_only_mmap)
+
+
+def _get_timestamp(last_modified):
+    # last_modified is in UTC, but may be parsed without a tzinfo
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return last_modified.timestamp()
+
+
+def _get_transfer_stats(transferred, skipped, failed, size, started):
+    seconds = time.monotonic() - started
+    return {
+        'transferred': transferred,
+        'skipped': skipped,
+        'failed': failed,
+        'bytes': size,
+        'seconds': seconds,
+        'bytes_per_second': size / seconds if seconds else 0.0
+    }
+
+
+class ADLSFileWriter:
+    '''
+    ADLSFileWriter - Writable file like Object which streams to an ADLS
+    file: the bytes written are cut into chunk_size pieces appended with
+    append_data at increasing offsets, up to max_in_flight appends running
+    at a time, and committed with a single flush_data on close. Besides
+    the bytes of the current write call, memory use is bounded by
+    chunk_size * (max_in_flight + 1).
+    rename_to: '{file_system}/{path}' to move the file to once it is
+    committed. Write to a temporary file_client with rename_to set to
+    keep the target untouched until close, abort then deletes the
+    temporary file. Without it the file at file_client is replaced from
+    the start, so a failed write leaves it empty or partial.
+    Use it as a context manager, the file is only committed when the block
+    exits without an exception.
+    '''
+    def __init__(
+        self, file_client, chunk_size=8 * 1024 * 1024, max_in_flight=4,
+        rename_to=None
+    ):
+        self.file_client = file_client
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.rename_to = rename_to
+        self.closed = False
+        self._buffer = []
+        self._buffered = 0
+        self._offset = 0
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.file_client.create_file()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        '''
+        Buffer bytes or str (written as utf-8) and append every full chunk
+        '''
+        if self.closed:
+            raise ValueError('I/O operation on closed ADLSFileWriter')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_size:
+            buffered = b''.join(self._buffer)
+            end = len(buffered) - len(buffered) % self.chunk_size
+            for start in range(0, end, self.chunk_size):
+                self._append(buffered[start: start + self.chunk_size])
+            self._buffer = [buffered[end:]] if end < len(buffered) else []
+            self._buffered = len(buffered) - end
+        return len(data)
+
+    def flush(self):
+        '''
+        Kept for file like compatibility, the data is committed on close
+        '''
+
+    def _append(self, data):
+        self._pending.add(self._executor.submit(
+            self.file_client.append_data, data, self._offset, len(data)))
+        self._offset += len(data)
+        if len(self._pending) >= self.max_in_flight:
+            done, self._pending = wait(
+                self._pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+    def close(self):
+        '''
+        Append the buffered data, wait for every append and commit the file
+        with flush_data, then move it to rename_to when set
+        '''
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._append(b''.join(self._buffer))
+            self._buffer = []
+            for future in self._pending:
+                future.result()
+            self.file_client.flush_data(self._offset)
+            if self.rename_to is not None:
+                self.file_client.rename_file(self.rename_to)
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self.closed = True
+            self._executor.shutdown(wait=True)
+
+    def abort(self):
+        '''
+        Stop writing without committing the appended data, deleting the
+        temporary file when rename_to is set
+        '''
+        self.closed = True
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        if self.rename_to is not None:
+            try:
+                self.file_client.delete_file()
+            except ResourceNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ADLSChangeTracker(ChangeTracker):
+    '''
+    ADLSChangeTracker - Incremental listing of the files under path in
+    a file system, against the state of the previous run kept in a local
+    PathManifest at manifest_path.
+    get_changes returns the PathProperties of the files which are new or
+    changed (in last_modified, etag or content length) and the names of
+    the files deleted since the last commit, commit records the listing as
+    processed, so a run which fails in between sees the same changes again.
+    '''
+    def __init__(self, adls, file_system, manifest_path: str, path=None):
+        self.adls = adls
+        self.file_system = file_system
+        self.path = path
+        super().__init__(manifest_path, self._list_entries)
+
+    def _list_entries(self):
+        file_system_client = self.adls.service_client.get_file_system_client(
+            self.file_system)
+        return (
+            (path.name, path.content_length, path.etag, path.last_modified,
+             path)
+            for path in file_system_client.get_paths(
+                path=self.path, recursive=True)
+            if not path.is_directory
+        )
+
 
 class ADLSInterface:
     '''
@@ -12,10 +193,18 @@ class ADLSInterface:
     :params:
         sa_name: The name of the storage account to use
         sa_key: The key for the storage account to use
+        cache: optional DiskCache to keep downloaded files on local disk
+        and only revalidate them with their ETag on later reads
+        shared_client: take the DataLakeServiceClient from the process wide
+        SERVICE_CLIENT_REGISTRY (default True)
     '''
-    def __init__(self, sa_name, spn_credentials):
+    def __init__(
+        self, sa_name, spn_credentials, cache=None, shared_client=True
+    ):
         self.storage_account_name = sa_name
         self.spn_credentials = spn_credentials
+        self.cache = cache
+        self.shared_client = shared_client
         self.service_client = self._get_service_client()
 
     def __get_credential(self):
@@ -26,8 +215,11 @@ class ADLSInterface:
         )
 
     def _get_service_client(self):
-        credential = self.__get_credential()
         url = f'https://{self.storage_account_name}.dfs.core.windows.net/'
+        if self.shared_client:
+            return SERVICE_CLIENT_REGISTRY.get_datalake_service_client(
+                url, self.spn_credentials)
+        credential = self.__get_credential()
         return DataLakeServiceClient(
             account_url=url,
             credential=credential
@@ -36,14 +228,324 @@ class ADLSInterface:
     def _get_file_client(self, path: str, file_system):
         return self.service_client.get_file_client(file_system, path)
 
-    def get_file(self, remotepath: str, file_system):
+    def _download_file(self, remotepath: str, file_system, **kwargs):
         '''
-        Open a file client to interact with the file and read the file directly
+        Start the download of the file, served by the cache as a
+        CachedDownload when one is set
         '''
         file_client = self._get_file_client(
             remotepath,
             file_system=file_system
         )
+        if self.cache is not None:
+            key = f'{self.storage_account_name}/{file_system}/{remotepath}'
+            return self.cache.read_through(
+                key, file_client.download_file, remotepath)
+        return file_client.download_file(**kwargs)
+
+    def get_file(self, remotepath: str, file_system):
+        '''
+        Open a file client to interact with the file and read the file directly
+        The returned BytesIO is positioned at the start of the content
+        '''
+        downloader = self._download_file(remotepath, file_system)
+        if isinstance(downloader, CachedDownload):
+            # BytesIO shares the bytes until the buffer is written to
+            return BytesIO(downloader.readall())
         buffer = BytesIO()
-        file_client.download_file().readinto(buffer)
+        downloader.readinto(buffer)
+        buffer.seek(0)
         return buffer
+
+    def iter_file_chunks(self, remotepath: str, file_system):
+        '''
+        Yield the content of the file as bytes chunks while it downloads,
+        for incremental processing without holding the whole file
+        '''
+        return self._download_file(remotepath, file_system).chunks()
+
+    def readinto(
+        self, remotepath: str, file_system, target, max_concurrency=8
+    ):
+        '''
+        Download the file straight into target, either an open (binary)
+        file like Object, which is written from its current position, or a
+        writable buffer such as a bytearray or memoryview, filled from its
+        start and at least as large as the file.
+        Returns the number of bytes written
+        '''
+        downloader = self._download_file(
+            remotepath, file_system, max_concurrency=max_concurrency)
+        if hasattr(target, 'write'):
+            return downloader.readinto(target)
+        view = memoryview(target).cast('B')
+        if downloader.size > len(view):
+            raise ValueError(
+                f'Buffer of {len(view)} bytes is too small for '
+                f'{downloader.size} bytes')
+        offset = 0
+        for chunk in downloader.chunks():
+            view[offset: offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return offset
+
+    def read_range(
+        self, remotepath: str, file_system, offset: int, length: int
+    ):
+        '''
+        Download and return length bytes of the file starting at offset
+        '''
+        file_client = self._get_file_client(
+            remotepath,
+            file_system=file_system
+        )
+        return file_client.download_file(
+            offset=offset, length=length).readall()
+
+    def download_to_file(
+        self, remotepath: str, file_system, file_path: str,
+        max_concurrency=8, as_mmap=False
+    ):
+        '''
+        Download the file into the local file at file_path, preallocated to
+        the file size, fetching max_concurrency ranges at a time and
+        writing each straight to its offset.
+        Returns the number of bytes downloaded, or with as_mmap = True a
+        read only mmap of the local file.
+        '''
+        file_client = self._get_file_client(
+            remotepath,
+            file_system=file_system
+        )
+        downloader = file_client.download_file(
+            max_concurrency=max_concurrency)
+        with open(file_path, 'wb') as file:
+            file.truncate(downloader.size)
+            size = downloader.readinto(file)
+        if as_mmap:
+            return open_read_only_mmap(file_path)
+        return size
+
+    def open_file(
+        self, remotepath: str, file_system, block_size=4 * 1024 * 1024
+    ):
+        '''
+        Open a read only, seekable file like Object over the file, which
+        downloads only the ranges read (at least block_size bytes each)
+        '''
+        file_client = self._get_file_client(
+            remotepath,
+            file_system=file_system
+        )
+        size = file_client.get_file_properties().size
+
+        def read_range(offset, length):
+            return file_client.download_file(
+                offset=offset, length=length).readall()
+
+        return open_range_reader(read_range, size, block_size)
+
+    def save_df_to_parquet(
+        self, dataframe, remotepath: str, file_system, row_group_size=None,
+        compression='snappy'
+    ):
+        '''
+        Save the dataframe as a .parquet file, with up to row_group_size
+        rows per row group
+        '''
+        file_client = self._get_file_client(
+            remotepath,
+            file_system=file_system
+        )
+        with tempfile.TemporaryFile() as file:
+            write_parquet(dataframe, file, row_group_size, compression)
+            file.seek(0)
+            file_client.upload_data(file, overwrite=True)
+
+    def get_df_from_parquet(
+        self, remotepath: str, file_system, columns=None, filters=None,
+        row_groups=None
+    ):
+        '''
+        Read a .parquet file into a dataframe with range reads, downloading
+        only the footer and the column chunks of the columns and row groups
+        needed. filters is a list of (column, op, value) tuples, row groups
+        whose statistics rule them out are not read.
+        '''
+        with self.open_file(remotepath, file_system) as file:
+            return read_parquet(file, columns, filters, row_groups)
+
+    def download_directory(
+        self, remote_dir: str, file_system, local_dir: str, max_workers=8
+    ):
+        '''
+        Download every file under remote_dir into local_dir, keeping the
+        directory structure, with up to max_workers downloads at a time.
+        Local files get the last_modified time of the remote file as mtime,
+        so files whose size and mtime already match are skipped and an
+        interrupted download can be resumed by running it again.
+        Returns a dict with the number of files transferred and skipped,
+        the failures as (path, error) tuples, the bytes downloaded, the
+        elapsed seconds and the bytes downloaded per second.
+        '''
+        started = time.monotonic()
+        file_system_client = self.service_client.get_file_system_client(
+            file_system)
+        prefix = remote_dir.strip('/')
+
+        def get_local_path(name):
+            relative_path = posixpath.relpath(name, prefix or '.')
+            return os.path.join(local_dir, *relative_path.split('/'))
+
+        def is_current(path):
+            try:
+                stat = os.stat(get_local_path(path.name))
+            except OSError:
+                return False
+            return stat.st_size == path.content_length and int(
+                stat.st_mtime) == int(_get_timestamp(path.last_modified))
+
+        def download(path):
+            local_path = get_local_path(path.name)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            part_path = local_path + '.part'
+            size = self.download_to_file(
+                path.name, file_system, part_path, max_concurrency=1)
+            mtime = _get_timestamp(path.last_modified)
+            os.utime(part_path, (mtime, mtime))
+            os.replace(part_path, local_path)
+            return size
+
+        skipped = 0
+        pending = []
+        for path in file_system_client.get_paths(
+            path=prefix or None, recursive=True
+        ):
+            if path.is_directory:
+                continue
+            if is_current(path):
+                skipped += 1
+            else:
+                pending.append(path)
+        transferred = 0
+        size = 0
+        failed = []
+        for path, result, error in imap_unordered(
+            download, pending, max_workers
+        ):
+            if error is not None:
+                failed.append((path.name, error))
+                continue
+            transferred += 1
+            size += result
+        return _get_transfer_stats(
+            transferred, skipped, failed, size, started)
+
+    def upload_directory(
+        self, local_dir: str, remote_dir: str, file_system, max_workers=8
+    ):
+        '''
+        Upload every file under local_dir to remote_dir, keeping the
+        directory structure, with up to max_workers uploads at a time.
+        Remote files of the same size which were last modified after the
+        local file are skipped, so an interrupted upload can be resumed by
+        running it again.
+        Returns the same statistics as download_directory.
+        '''
+        started = time.monotonic()
+        file_system_client = self.service_client.get_file_system_client(
+            file_system)
+        prefix = remote_dir.strip('/')
+        remote_paths = {}
+        try:
+            for path in file_system_client.get_paths(
+                path=prefix or None, recursive=True
+            ):
+                if not path.is_directory:
+                    remote_paths[path.name] = path
+        except ResourceNotFoundError:
+            pass
+
+        skipped = 0
+        pending = []
+        for directory, _, file_names in os.walk(local_dir):
+            for file_name in file_names:
+                local_path = os.path.join(directory, file_name)
+                relative_path = os.path.relpath(local_path, local_dir)
+                remote_path = posixpath.join(
+                    prefix, *relative_path.split(os.sep))
+                stat = os.stat(local_path)
+                remote = remote_paths.get(remote_path)
+                if remote is not None and (
+                    remote.content_length == stat.st_size
+                    and _get_timestamp(remote.last_modified) >= stat.st_mtime
+                ):
+                    skipped += 1
+                    continue
+                pending.append((local_path, remote_path, stat.st_size))
+
+        def upload(item):
+            local_path, remote_path, size = item
+            file_client = self._get_file_client(
+                remote_path,
+                file_system=file_system
+            )
+            with open(local_path, 'rb') as file:
+                file_client.upload_data(file, length=size, overwrite=True)
+            return size
+
+        transferred = 0
+        size = 0
+        failed = []
+        for item, result, error in imap_unordered(
+            upload, pending, max_workers
+        ):
+            if error is not None:
+                failed.append((item[1], error))
+                continue
+            transferred += 1
+            size += result
+        return _get_transfer_stats(
+            transferred, skipped, failed, size, started)
+
+    def open_writer(
+        self, remotepath: str, file_system, chunk_size=8 * 1024 * 1024,
+        max_in_flight=4
+    ):
+        '''
+        Return an ADLSFileWriter which streams the bytes written to it into
+        a temporary file next to remotepath, renamed over remotepath once
+        the writer is closed. The file at remotepath is only replaced when
+        the write completes.
+        '''
+        directory, file_name = posixpath.split(remotepath)
+        file_client = self._get_file_client(
+            posixpath.join(directory, f'.{file_name}.{uuid.uuid4().hex}.tmp'),
+            file_system=file_system
+        )
+        rename_to = (
+            f"{file_client.file_system_name}/{remotepath.lstrip('/')}")
+        return ADLSFileWriter(
+            file_client, chunk_size, max_in_flight, rename_to)
+
+    def save_df_to_csv(
+        self, dataframe, remotepath: str, file_system, chunk_rows=100000,
+        max_in_flight=4
+    ):
+        '''
+        Save the dataframe as a .csv file, serialized chunk_rows rows at a
+        time and streamed through an ADLSFileWriter
+        '''
+        with self.open_writer(
+            remotepath, file_system, max_in_flight=max_in_flight
+        ) as writer:
+            for start in range(0, max(len(dataframe), 1), chunk_rows):
+                writer.write(dataframe.iloc[start: start + chunk_rows].to_csv(
+                    index=False, header=start == 0))
+
+    def track_changes(self, file_system, manifest_path: str, path=None):
+        '''
+        Return an ADLSChangeTracker for the files under path, keeping its
+        state in the local manifest file at manifest_path
+        '''
+        return ADLSChangeTracker(self, file_system, manifest_path, path)
@@ -1,16 +1,183 @@
+import base64
+import codecs
+import hashlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from io import BytesIO, StringIO
+import itertools
 import json
+import re
+import tempfile
+import time
+import zlib
 
-from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobPrefix, BlobServiceClient, ContentSettings
+import pandas as pd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from utility_package.utils.client_registry_utility import (
+    SERVICE_CLIENT_REGISTRY)
+from utility_package.utils.concurrency_utility import (
+    batched, imap_unordered)
+from utility_package.utils.manifest_utility import ChangeTracker
+from utility_package.utils.parquet_utility import read_parquet, write_parquet
+from utility_package.utils.stream_utility import (
+    open_range_reader, open_read_only_mmap)
+
+
+# chunks are combined into blocks of at least this size before staging
+MIN_BLOCK_BYTES = 8 * 1024 * 1024
+# most subrequests the Blob Batch API accepts in one request
+MAX_BATCH_DELETE = 256
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# payloads are hashed in slices of this size
+_MD5_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def _iter_ndjson(chunks):
+    '''
+    This function yields the json documents of newline delimited json text
+    as the chunks (bytes) arrive.
+    '''
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def _iter_json_array(chunks):
+    '''
+    This function yields the elements of a top level json array as the
+    chunks (bytes) arrive, keeping only the unparsed text in memory.
+    '''
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = 0
+    exhausted = False
+    # what comes next: '[' to open the array, 'first' a value or ']',
+    # 'value' a value, ',' a separator or ']'
+    expect = '['
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if pos < len(buffer):
+            char = buffer[pos]
+            if expect == '[':
+                if char != '[':
+                    raise ValueError('Expected a top level json array')
+                pos += 1
+                expect = 'first'
+                continue
+            if expect in ('first', ',') and char == ']':
+                return
+            if expect == ',':
+                if char != ',':
+                    raise ValueError(
+                        f'Unexpected character {char!r} in json array')
+                pos += 1
+                expect = 'value'
+                continue
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if exhausted:
+                    raise
+                end = None
+            # a value is only complete once followed by a delimiter,
+            # e.g. '1' may continue as '1.5' in the next chunk
+            if end is not None and (
+                exhausted or end < len(buffer) and buffer[end] in ', \t\n\r]'
+            ):
+                yield record
+                pos = end
+                expect = ','
+                continue
+        if exhausted:
+            raise ValueError('Unexpected end of json array')
+        chunk = next(chunks, None)
+        buffer = buffer[pos:]
+        pos = 0
+        if chunk is None:
+            buffer += utf8_decoder.decode(b'', final=True)
+            exhausted = True
+        else:
+            buffer += utf8_decoder.decode(chunk)
+
+
+def _iter_json(chunks, json_format='auto'):
+    '''
+    This function yields the records of a json array or ndjson text.
+    json_format = 'auto' detects the format from the first character.
+    '''
+    chunks = iter(chunks)
+    if json_format == 'auto':
+        head = []
+        for chunk in chunks:
+            head.append(chunk)
+            if chunk.strip():
+                break
+        first_char = b''.join(head).lstrip()[:1]
+        json_format = 'array' if first_char == b'[' else 'ndjson'
+        chunks = itertools.chain(head, chunks)
+    if json_format == 'array':
+        return _iter_json_array(chunks)
+    if json_format == 'ndjson':
+        return _iter_ndjson(chunks)
+    raise ValueError(f'Unsupported json_format {json_format}')
+
+
+def _get_md5(data: bytes):
+    '''
+    This function returns the MD5 digest of data, hashing it slice by
+    slice through a memoryview so the payload is never copied.
+    '''
+    md5 = hashlib.md5()
+    view = memoryview(data)
+    for start in range(0, len(view), _MD5_CHUNK_BYTES):
+        md5.update(view[start: start + _MD5_CHUNK_BYTES])
+    return md5.digest()
+
+
+def _get_compressor(compression):
+    '''
+    This function returns a streaming compressor object (with compress and
+    flush) for the compression, or None for no compression.
+    '''
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError(
+                'zstandard needs to be installed for zstd compression')
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f'Unsupported compression {compression}')
 
 
 class BlobConnection:
     '''
     This Class is used to make a connection to the Storage Account using the
     connecton string(Full or SAS URI connection string).
+    Pass a DiskCache as cache to keep downloaded blobs on local disk and
+    only revalidate them with their ETag on later reads.
+    shared_client = True (default) takes the BlobServiceClient from the
+    process wide SERVICE_CLIENT_REGISTRY, shared by every BlobConnection
+    with the same connection string.
     '''
-    def __init__(self, blob_conn_str: str):
+    def __init__(self, blob_conn_str: str, cache=None, shared_client=True):
         self.blob_conn_str = blob_conn_str
+        self.cache = cache
+        self.shared_client = shared_client
         self.blob_service_client = self._get_blob_service_client()
 
     def _get_blob_service_client(self):
@@ -18,6 +185,9 @@ class BlobConnection:
         This method is used to return a BlobServiceClient Object, to enable
         operations on blob
         '''
+        if self.shared_client:
+            return SERVICE_CLIENT_REGISTRY.get_blob_service_client(
+                self.blob_conn_str)
         return BlobServiceClient.from_connection_string(self.blob_conn_str)
 
     def _get_blob_client(self, container: str, blob_path: str):
@@ -36,11 +206,67 @@ class BlobConnection:
         '''
         This method downloads and retuns the blob specified by blob_path
         in the container 'container' as StorageStreamDownloader Object.
+        With a cache, the content is served from the cache as a
+        CachedDownload Object when the blob has not changed.
         '''
         blob_client = self._get_blob_client(container, blob_path)
+        if self.cache is not None:
+            key = f'{blob_client.account_name}/{container}/{blob_path}'
+            return self.cache.read_through(
+                key, blob_client.download_blob, blob_path)
         data = blob_client.download_blob()
         return data
 
+    def read_range(
+        self, container: str, blob_path: str, offset: int, length: int
+    ):
+        '''
+        This method downloads and returns length bytes of the blob starting
+        at offset, e.g. the footer of a parquet file.
+        '''
+        blob_client = self._get_blob_client(container, blob_path)
+        return blob_client.download_blob(
+            offset=offset, length=length).readall()
+
+    def download_to_file(
+        self, container: str, blob_path: str, file_path: str,
+        max_concurrency=8, as_mmap=False
+    ):
+        '''
+        This method downloads the blob into the local file at file_path.
+        The file is preallocated to the blob size and max_concurrency
+        ranges of the blob are fetched at a time, each written straight to
+        its offset in the file.
+        Returns the number of bytes downloaded, or with as_mmap = True a
+        read only mmap of the file.
+        '''
+        blob_client = self._get_blob_client(container, blob_path)
+        downloader = blob_client.download_blob(
+            max_concurrency=max_concurrency)
+        with open(file_path, 'wb') as file:
+            file.truncate(downloader.size)
+            size = downloader.readinto(file)
+        if as_mmap:
+            return open_read_only_mmap(file_path)
+        return size
+
+    def open_blob(
+        self, container: str, blob_path: str, block_size=4 * 1024 * 1024
+    ):
+        '''
+        This method returns a read only, seekable file like Object over the
+        blob, which downloads only the ranges read (at least block_size
+        bytes per request).
+        '''
+        blob_client = self._get_blob_client(container, blob_path)
+        size = blob_client.get_blob_properties().size
+
+        def read_range(offset, length):
+            return blob_client.download_blob(
+                offset=offset, length=length).readall()
+
+        return open_range_reader(read_range, size, block_size)
+
     def get_json_object(self, container: str, blob_path: str):
         '''
         This method read the StorageStreamDownloader Object as a Stream
@@ -53,28 +279,201 @@ class BlobConnection:
         buffer.seek(0)
         return json.load(buffer)
 
-    def save_file(self, data: bytes, container: str, blob_path: str):
+    def iter_json_records(
+        self, container: str, blob_path: str, json_format='auto'
+    ):
+        '''
+        This method parses the blob while its chunks are downloaded and
+        yields the records one at a time, so memory use does not depend on
+        the blob size.
+        json_format is 'ndjson' (one json document per line), 'array'
+        (a top level json array) or 'auto' to detect it.
+        '''
+        data = self.get_file(container, blob_path)
+        return _iter_json(data.chunks(), json_format)
+
+    def iter_json_df_batches(
+        self, container: str, blob_path: str, batch_rows=10000,
+        json_format='auto'
+    ):
+        '''
+        This method yields the records of iter_json_records as dataframes
+        of up to batch_rows rows.
+        '''
+        batch = []
+        for record in self.iter_json_records(
+            container, blob_path, json_format
+        ):
+            batch.append(record)
+            if len(batch) == batch_rows:
+                yield pd.DataFrame(batch)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch)
+
+    def save_file(
+        self, data: bytes, container: str, blob_path: str,
+        skip_unchanged=False
+    ):
         '''
         This method is used to save the bytes data as a blob in the container.
+        With skip_unchanged = True the MD5 of data is compared with the
+        content_md5 of the stored blob first and the upload is skipped when
+        they match. The MD5 is stored with the blob on every upload.
+        Returns True if the blob was written, False if it was skipped.
         '''
         blob_client = self._get_blob_client(container, blob_path)
-        blob_client.upload_blob(data, overwrite=True)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        content_md5 = _get_md5(data)
+        if skip_unchanged:
+            try:
+                properties = blob_client.get_blob_properties()
+            except ResourceNotFoundError:
+                properties = None
+            if properties is not None and bytes(
+                properties.content_settings.content_md5 or b''
+            ) == content_md5:
+                return False
+        blob_client.upload_blob(
+            data, overwrite=True,
+            content_settings=ContentSettings(content_md5=content_md5))
+        return True
+
+    def download_many(self, container: str, blob_paths, max_workers=16):
+        '''
+        This method downloads the blobs concurrently, at most max_workers
+        at a time, and yields (blob_path, data, error) tuples as each
+        download completes. data is the blob content as bytes, or None with
+        the exception in error when that download failed.
+        '''
+        def download(blob_path):
+            return self.get_file(container, blob_path).readall()
+
+        return imap_unordered(download, blob_paths, max_workers)
 
-    def save_json(self, json_object: object, container: str, blob_path: str):
+    def upload_many(
+        self, container: str, items, max_workers=16, skip_unchanged=False
+    ):
+        '''
+        This method uploads (blob_path, data) pairs concurrently, at most
+        max_workers at a time, and yields (blob_path, result, error) tuples
+        as each upload completes, where result is the return value of
+        save_file. Failed uploads have the exception in error.
+        '''
+        def upload(item):
+            blob_path, data = item
+            return self.save_file(data, container, blob_path, skip_unchanged)
+
+        for item, result, error in imap_unordered(upload, items, max_workers):
+            yield item[0], result, error
+
+    def save_json(
+        self, json_object: object, container: str, blob_path: str,
+        skip_unchanged=False
+    ):
         '''
         This method is used to save/overwrite the json file as a blob in the
-        container
+        container. skip_unchanged = True skips the upload when the stored
+        blob has the same content, returns True if the blob was written.
         '''
         data = json.dumps(json_object, indent=2).encode('utf-8')
-        self.save_file(data, container, blob_path)
+        return self.save_file(data, container, blob_path, skip_unchanged)
 
-    def save_df_to_csv(self, dataframe, container: str, blob_path: str):
+    def save_df_to_csv(
+        self, dataframe, container: str, blob_path: str, chunk_rows=None,
+        compression=None, max_concurrency=4
+    ):
         '''
         This method is used to save a dataframe to blob as .csv file
+        Passing chunk_rows or compression ('gzip' or 'zstd') streams the
+        csv instead: the dataframe is serialized chunk_rows rows at a time
+        (100k by default), optionally compressed, and staged as blocks with
+        up to max_concurrency uploads running while the next chunk is
+        serialized, so the full csv is never held in memory.
         '''
-        buffer = StringIO()
-        dataframe.to_csv(buffer, index=False, header=True)
-        self.save_file(buffer.getvalue(), container, blob_path)
+        if chunk_rows is None and compression is None:
+            buffer = StringIO()
+            dataframe.to_csv(buffer, index=False, header=True)
+            self.save_file(buffer.getvalue(), container, blob_path)
+            return
+        self._save_df_to_csv_in_blocks(
+            dataframe, container, blob_path, chunk_rows or 100000,
+            compression, max_concurrency)
+
+    def _save_df_to_csv_in_blocks(
+        self, dataframe, container, blob_path, chunk_rows, compression,
+        max_concurrency
+    ):
+        blob_client = self._get_blob_client(container, blob_path)
+        compressor = _get_compressor(compression)
+        block_ids = []
+        block = []
+        block_size = 0
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            pending = set()
+
+            def stage_block(data):
+                block_id = base64.b64encode(
+                    f'{len(block_ids):08d}'.encode()).decode()
+                block_ids.append(block_id)
+                pending.add(
+                    executor.submit(blob_client.stage_block, block_id, data))
+                # bound the memory held by blocks waiting to be uploaded
+                if len(pending) >= max_concurrency:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        future.result()
+
+            for start in range(0, max(len(dataframe), 1), chunk_rows):
+                data = dataframe.iloc[start: start + chunk_rows].to_csv(
+                    index=False, header=start == 0).encode('utf-8')
+                if compressor is not None:
+                    data = compressor.compress(data)
+                block.append(data)
+                block_size += len(data)
+                if block_size >= MIN_BLOCK_BYTES:
+                    stage_block(b''.join(block))
+                    block = []
+                    block_size = 0
+            if compressor is not None:
+                block.append(compressor.flush())
+            if block or not block_ids:
+                stage_block(b''.join(block))
+            for future in pending:
+                future.result()
+        blob_client.commit_block_list(block_ids)
+
+    def save_df_to_parquet(
+        self, dataframe, container: str, blob_path: str, row_group_size=None,
+        compression='snappy', max_concurrency=4
+    ):
+        '''
+        This method is used to save a dataframe to blob as .parquet file,
+        with up to row_group_size rows per row group. The file is written
+        to a local temporary file and uploaded with up to max_concurrency
+        blocks at a time.
+        '''
+        with tempfile.TemporaryFile() as file:
+            write_parquet(dataframe, file, row_group_size, compression)
+            file.seek(0)
+            blob_client = self._get_blob_client(container, blob_path)
+            blob_client.upload_blob(
+                file, overwrite=True, max_concurrency=max_concurrency)
+
+    def get_df_from_parquet(
+        self, container: str, blob_path: str, columns=None, filters=None,
+        row_groups=None
+    ):
+        '''
+        This method reads a .parquet blob into a dataframe with range reads,
+        downloading only the footer and the column chunks of the columns
+        and row groups needed. filters is a list of (column, op, value)
+        tuples, row groups whose statistics rule them out are not read.
+        '''
+        with self.open_blob(container, blob_path) as file:
+            return read_parquet(file, columns, filters, row_groups)
 
     def list_files(self, container: str, directory_name=None):
         container_client = self._get_container_client(container)
@@ -86,6 +485,122 @@ class BlobConnection:
             )
         return blob_list
 
+    def list_files_parallel(
+        self, container: str, directory_name=None, depth=2, max_workers=8
+    ):
+        '''
+        This method lists the blobs under directory_name (the whole
+        container when None) concurrently. The first depth levels of
+        virtual directories are walked with the '/' delimiter to shard the
+        namespace into prefixes, which are then listed max_workers at a
+        time. Yields BlobProperties in no particular order.
+        '''
+        container_client = self._get_container_client(container)
+        prefixes = [None if directory_name is None else directory_name + '/']
+
+        def walk_prefix(prefix):
+            return list(container_client.walk_blobs(
+                name_starts_with=prefix, delimiter='/'))
+
+        def list_prefix(prefix):
+            return list(container_client.list_blobs(name_starts_with=prefix))
+
+        for _ in range(depth):
+            sub_prefixes = []
+            for _, items, error in imap_unordered(
+                walk_prefix, prefixes, max_workers
+            ):
+                if error is not None:
+                    raise error
+                for item in items:
+                    if isinstance(item, BlobPrefix):
+                        sub_prefixes.append(item.name)
+                    else:
+                        yield item
+            prefixes = sub_prefixes
+        for _, blobs, error in imap_unordered(
+            list_prefix, prefixes, max_workers
+        ):
+            if error is not None:
+                raise error
+            yield from blobs
+
+    def track_changes(
+        self, container: str, manifest_path: str, directory_name=None,
+        depth=2, max_workers=8
+    ):
+        '''
+        This method returns a ChangeTracker over the blobs listed with
+        list_files_parallel, keeping its state in the local PathManifest at
+        manifest_path. get_changes returns the BlobProperties of the new or
+        changed blobs and the names of the blobs deleted since the last
+        commit; call commit once the changes are processed.
+        '''
+        def list_entries():
+            return (
+                (blob.name, blob.size, blob.etag, blob.last_modified, blob)
+                for blob in self.list_files_parallel(
+                    container, directory_name, depth, max_workers)
+            )
+
+        return ChangeTracker(manifest_path, list_entries)
+
     def delete_blobs(self, container: str, blob_path: str):
         blob_client = self._get_blob_client(container, blob_path)
         blob_client.delete_blob(delete_snapshots='include')
+
+    def delete_blobs_batch(self, container: str, blob_paths, max_workers=4):
+        '''
+        This method deletes the blobs (including their snapshots) through
+        the Blob Batch API, MAX_BATCH_DELETE blobs per request with up to
+        max_workers requests running at a time.
+        Returns a dict with the number of blobs deleted, the failures as
+        (blob_path, status_code, reason) tuples, the elapsed seconds and
+        the blobs deleted per second.
+        '''
+        container_client = self._get_container_client(container)
+        started = time.monotonic()
+
+        def delete_batch(batch):
+            responses = container_client.delete_blobs(
+                *batch,
+                delete_snapshots='include',
+                raise_on_any_failure=False
+            )
+            return [
+                (blob_path, response.status_code, response.reason)
+                for blob_path, response in zip(batch, responses)
+            ]
+
+        deleted = 0
+        failed = []
+        for batch, results, error in imap_unordered(
+            delete_batch, batched(blob_paths, MAX_BATCH_DELETE), max_workers
+        ):
+            if error is not None:
+                failed.extend(
+                    (blob_path, None, str(error)) for blob_path in batch)
+                continue
+            for blob_path, status_code, reason in results:
+                if status_code in (200, 202):
+                    deleted += 1
+                else:
+                    failed.append((blob_path, status_code, reason))
+        seconds = time.monotonic() - started
+        return {
+            'deleted': deleted,
+            'failed': failed,
+            'seconds': seconds,
+            'blobs_per_second': deleted / seconds if seconds else 0.0
+        }
+
+    def delete_directory(
+        self, container: str, directory_name: str, max_workers=4
+    ):
+        '''
+        This method deletes every blob under directory_name, feeding the
+        list_files results into delete_blobs_batch as they are listed.
+        '''
+        blob_paths = (
+            blob.name for blob in self.list_files(container, directory_name))
+        return self.delete_blobs_batch(container, blob_paths, max_workers)
@@ -0,0 +1,98 @@
+import atexit
+import threading
+
+from azure.core.pipeline.transport import RequestsTransport
+from azure.identity import ClientSecretCredential
+from azure.storage.blob import BlobServiceClient
+from azure.storage.filedatalake import DataLakeServiceClient
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ServiceClientRegistry:
+    '''
+    Class ServiceClientRegistry hands out one storage service client per
+    account and credentials for the whole process, so connection objects
+    created in a hot path reuse the client, its credential and its pooled
+    HTTP connections (no new TCP/TLS handshakes).
+    pool_connections: number of hosts the HTTP session keeps pools for
+    pool_maxsize: connections kept open per host, raise it for high
+    concurrency (settings apply to clients created afterwards)
+    '''
+    def __init__(self, pool_connections=10, pool_maxsize=64):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._clients = {}
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def configure(self, pool_connections=None, pool_maxsize=None):
+        if pool_connections is not None:
+            self.pool_connections = pool_connections
+        if pool_maxsize is not None:
+            self.pool_maxsize = pool_maxsize
+
+    def _get_transport(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self._sessions.append(session)
+        return RequestsTransport(session=session, session_owner=False)
+
+    def get_client(self, key, factory):
+        '''
+        This method returns the client registered for the key, creating it
+        with factory(transport=...) on first use.
+        '''
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = factory(transport=self._get_transport())
+                self._clients[key] = client
+            return client
+
+    def get_blob_service_client(self, conn_str: str):
+        return self.get_client(
+            ('blob', conn_str),
+            lambda **kwargs: BlobServiceClient.from_connection_string(
+                conn_str, **kwargs)
+        )
+
+    def get_datalake_service_client(self, account_url: str, spn_credentials):
+        tenant_id = spn_credentials['tenant_id']
+        client_id = spn_credentials['spn_id']
+        client_secret = spn_credentials['spn_password']
+
+        def factory(**kwargs):
+            credential = ClientSecretCredential(
+                tenant_id, client_id, client_secret)
+            return DataLakeServiceClient(
+                account_url=account_url, credential=credential, **kwargs)
+
+        return self.get_client(
+            ('datalake', account_url, tenant_id, client_id, client_secret),
+            factory
+        )
+
+    def close(self):
+        '''
+        This method closes every registered client and HTTP session, later
+        calls create new ones.
+        '''
+        with self._lock:
+            clients = list(self._clients.values())
+            sessions = self._sessions
+            self._clients = {}
+            self._sessions = []
+        for client in clients:
+            client.close()
+        for session in sessions:
+            session.close()
+
+
+SERVICE_CLIENT_REGISTRY = ServiceClientRegistry()
+atexit.register(SERVICE_CLIENT_REGISTRY.close)
@@ -0,0 +1,47 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+
+def imap_unordered(func, items, max_workers=8):
+    '''
+    This function calls func on every item on a pool of max_workers threads
+    and yields (item, result, error) tuples as the calls complete.
+    error is None for the calls that succeeded, otherwise result is None
+    and error is the exception raised, so one failure does not stop the
+    others.
+    Items are submitted lazily with at most 2 * max_workers calls pending,
+    so results are never buffered far ahead of the consumer.
+    '''
+    items = iter(items)
+    max_pending = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {
+            executor.submit(func, item): item
+            for item in islice(items, max_pending)
+        }
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    try:
+                        result, error = future.result(), None
+                    except Exception as err:  # pylint: disable=W0703
+                        result, error = None, err
+                    yield item, result, error
+                for item in islice(items, max_pending - len(pending)):
+                    pending[executor.submit(func, item)] = item
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def batched(items, batch_size):
+    '''
+    This function yields lists of up to batch_size consecutive items.
+    '''
+    items = iter(items)
+    batch = list(islice(items, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(items, batch_size))
@@ -1,13 +1,229 @@
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import decimal
+import functools
+import math
+import re
+import struct
+import threading
+import time
+from urllib.parse import urlparse
 
+import numpy as np
 import pandas as pd
 import pyodbc
+from azure.identity import ClientSecretCredential
+
+from utility_package.utils.logging_utility import get_logger
+from utility_package.utils.refresh_cache_utility import RefreshingCache
+
+LOGGER = get_logger(__name__)
+
+# SQL Server limit on the number of parameters of a single statement
+MAX_SQL_PARAMS = 2100
+# pyodbc connection attribute to pass an AAD access token
+SQL_COPT_SS_ACCESS_TOKEN = 1256
 
 
 class SQLException(Exception):
     pass
 
 
+class AccessTokenCache:
+    '''
+    Class AccessTokenCache caches the AAD access tokens of SPNs, keyed by
+    authority, tenant, client and resource.
+    A token is reused until it is within refresh_margin seconds of expiry,
+    from then on it is still served while a new one is fetched in the
+    background. Only a token within min_validity seconds of expiry is
+    refreshed while the caller waits.
+    '''
+    def __init__(self, refresh_margin=600, min_validity=60):
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self._tokens = RefreshingCache(refresh_margin, min_validity)
+        self._credentials = {}
+        self._lock = threading.Lock()
+
+    def _get_credential(self, key, client_secret):
+        tenant_id, client_id, _, authority_host_url = key
+        with self._lock:
+            cached = self._credentials.get(key)
+            if cached is None or cached[0] != client_secret:
+                # azure-identity expects the authority host without scheme
+                credential = ClientSecretCredential(
+                    tenant_id,
+                    client_id,
+                    client_secret,
+                    authority=(
+                        urlparse(authority_host_url).netloc
+                        or authority_host_url)
+                )
+                cached = (client_secret, credential)
+                self._credentials[key] = cached
+                # tokens of the previous secret are not reused
+                self._tokens.invalidate(key)
+            return cached[1]
+
+    def get_token(
+        self, tenant_id, client_id, client_secret, resource_uri,
+        authority_host_url='https://login.microsoftonline.com'
+    ):
+        '''
+        This function returns the access token string for the SPN and
+        resource.
+        '''
+        key = (tenant_id, client_id, resource_uri, authority_host_url)
+        credential = self._get_credential(key, client_secret)
+        scope = resource_uri.rstrip('/') + '/.default'
+
+        def fetch():
+            token = credential.get_token(scope)
+            return token, token.expires_on
+
+        return self._tokens.get(key, fetch).token
+
+    def clear(self):
+        with self._lock:
+            self._credentials.clear()
+            self._tokens.invalidate()
+
+
+ACCESS_TOKEN_CACHE = AccessTokenCache()
+
+
+class ResultCache:
+    '''
+    Class ResultCache is a thread safe cache of query result dataframes,
+    shared by the DBConnection objects it is passed to. DBConnection puts
+    its (server, db_name) into every key, so connections to different
+    databases can share one cache.
+    ttl: seconds an entry stays valid, None for no expiry
+    max_entries, max_bytes: bounds past which the least recently used
+    entries are evicted
+    Cached dataframes are never handed out directly, every hit returns a
+    copy so callers cannot modify the cached data.
+    '''
+    def __init__(self, ttl=300, max_entries=128, max_bytes=256 * 1024 ** 2):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def query_key(query, database=None):
+        '''
+        The key of a query is the database, e.g. (server, db_name), and the
+        query text with the whitespace outside of string literals collapsed.
+        '''
+        parts = re.split(r"('(?:[^']|'')*')", query.strip())
+        normalized = ''.join(
+            part if i % 2 else ' '.join(part.split())
+            for i, part in enumerate(parts)
+        )
+        return ('query', database, normalized)
+
+    @staticmethod
+    def stored_proc_key(schema, stored_proc, params=None, database=None):
+        params_key = tuple(sorted(
+            (key, repr(value)) for key, value in (params or {}).items()))
+        return (
+            'stored_proc', database, schema.lower(), stored_proc.lower(),
+            params_key
+        )
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return entry[0].copy()
+
+    def put(self, key, result_df):
+        nbytes = int(result_df.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        expires_at = float('inf') if self.ttl is None else (
+            time.monotonic() + self.ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result_df, nbytes, expires_at)
+            self._bytes += nbytes
+            while (
+                len(self._entries) > self.max_entries
+                or self._bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def get_or_load(self, key, loader):
+        '''
+        This function returns the cached dataframe for the key, calling
+        loader to fetch and cache it on a miss.
+        '''
+        result_df = self.get(key)
+        if result_df is None:
+            result_df = loader()
+            self.put(key, result_df)
+            result_df = result_df.copy()
+        return result_df
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def invalidate(self, key=None):
+        '''
+        This function removes the entry for the key, or every entry when
+        no key is passed.
+        '''
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif key in self._entries:
+                self._remove(key)
+
+    def invalidate_stored_proc(self, schema, stored_proc, database=None):
+        '''
+        This function removes the entries of the stored proc for all params,
+        in the database or in every database when it is None.
+        '''
+        proc_key = ResultCache.stored_proc_key(schema, stored_proc)
+
+        def matches(key):
+            return (
+                isinstance(key, tuple) and len(key) == len(proc_key)
+                and key[0] == proc_key[0] and key[2:4] == proc_key[2:4]
+                and (database is None or key[1] == database)
+            )
+
+        with self._lock:
+            for key in [key for key in self._entries if matches(key)]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self._bytes
+            }
+
+
 class DBConnection:
     '''
     Class DBConnection creates connection as a class attribute
@@ -16,6 +232,11 @@ class DBConnection:
     spn_auth = True will do a SPN auth using SPN client_id and client_secret
     Pass Client ID as user_name and Client Secret as pwd along with Tenant ID
     when spn_auth = True
+    Pass a ResultCache as result_cache to cache the dataframes returned by
+    get_df_from_query and get_df_from_stored_proc, for the calls which
+    opt in with use_cache = True
+    bind_params = True sends the stored proc params as bound parameters
+    instead of inlining them into the EXEC statement
     '''
     def __init__(self, server, db_name, user_name, pwd, **kwargs):
         self.server = server
@@ -23,6 +244,7 @@ class DBConnection:
         self.user_name = user_name
         self.pwd = pwd
         self.driver = kwargs.get('driver', '{ODBC Driver 17 for SQL Server}')
+        self.result_cache = kwargs.get('result_cache')
         self.connection = None
         self.args = kwargs
         self.refresh_connection()
@@ -42,6 +264,39 @@ class DBConnection:
                 resource_uri,
                 tenant_id)
 
+    def spn_sql_auth(self, authority_host_url, resource_uri, tenant_id):
+        '''
+        This method gets invoked when the spn_auth flag is True and
+        connects with an AAD access token of the SPN (user_name is the
+        client id and pwd the client secret). Tokens are served by the
+        process wide ACCESS_TOKEN_CACHE, so reconnects do not hit AAD.
+        '''
+        try:
+            token = ACCESS_TOKEN_CACHE.get_token(
+                tenant_id,
+                self.user_name,
+                self.pwd,
+                resource_uri,
+                authority_host_url
+            )
+            token_bytes = token.encode('utf-16-le')
+            token_struct = struct.pack(
+                f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
+            connstring = f'DRIVER={self.driver};'
+            connstring += f'SERVER={self.server};'
+            connstring += f'DATABASE={self.db_name}'
+
+            self.connection = pyodbc.connect(
+                connstring,
+                attrs_before={SQL_COPT_SS_ACCESS_TOKEN: token_struct}
+            )
+            self.connection.autocommit = True
+
+        except Exception as err:
+            if self.connection is not None:
+                self.connection.close()
+            raise SQLException(err)
+
     def sql_server_auth(self):
         '''
         This method gets invoked when the spn_auth flag is False
@@ -62,6 +317,26 @@ class DBConnection:
                 self.connection.close()
             raise SQLException(err)
 
+    def _execute_query(self, query):
+        '''
+        This function executes the query on a new cursor and returns the
+        cursor. The connection is refreshed once if it has timed out.
+        '''
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute(query)
+        # Connection timeout
+        except pyodbc.OperationalError:
+            self.refresh_connection()
+            cursor = self.connection.cursor()
+            cursor.execute(query)
+        return cursor
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
     def run_sql_query(self, query):
         '''
         This function runs a query and return the column names and the
@@ -73,14 +348,7 @@ class DBConnection:
         if both results and columns is a non empty list, then the query is a
         non empty result set query.
         '''
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
-        # Connection timeout
-        except pyodbc.OperationalError:
-            self.refresh_connection()
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+        cursor = self._execute_query(query)
         # check if cursor is result set cursor or non-result set cursor
         if cursor.description is not None:
             results = cursor.fetchall()
@@ -91,25 +359,55 @@ class DBConnection:
         cursor.close()
         return results, columns
 
-    def run_stored_proc(self, schema, stored_proc, params=None):
+    @staticmethod
+    def _form_stored_proc_stmt(
+        schema, stored_proc, params=None, bind_params=False
+    ):
         '''
-        This function accepts teh schema name, stored proc name and
-        parmas(dict).
-        The function runs the SP with the desired params and then returns
-        result set and columns if any.
+        This function builds the EXEC statement for the stored proc and
+        returns it along with the values to bind.
+        bind_params = False inlines the param values into the statement,
+        bind_params = True uses a ? marker per param and returns the values
+        to be bound by the driver, so that the server can reuse the plan
+        across values.
         '''
         stored_proc_name = f'[{schema}].[{stored_proc}]'
         sql_stmt = f"SET NOCOUNT ON;EXEC {stored_proc_name}"
+        values = []
         if params is not None:
             for key, value in params.items():
-                if isinstance(value, str):
+                if bind_params:
+                    sql_stmt += f"@{key}=?,"
+                    values.append(value)
+                elif value is None:
+                    sql_stmt += f"@{key}=NULL,"
+                elif isinstance(value, str):
+                    value = value.replace("'", "''")
                     sql_stmt += f"@{key}='{value}',"
                 else:
                     sql_stmt += f"@{key}={value},"
             sql_stmt = sql_stmt.rstrip(',')
         sql_stmt += ';'
+        return sql_stmt, values
+
+    def _execute_stored_proc(self, schema, stored_proc, params=None):
+        sql_stmt, values = self._form_stored_proc_stmt(
+            schema, stored_proc, params, self.args.get('bind_params', False))
         cursor = self.connection.cursor()
-        cursor.execute(sql_stmt.replace('None', 'NULL'))
+        if values:
+            cursor.execute(sql_stmt, values)
+        else:
+            cursor.execute(sql_stmt)
+        return cursor
+
+    def run_stored_proc(self, schema, stored_proc, params=None):
+        '''
+        This function accepts teh schema name, stored proc name and
+        parmas(dict).
+        The function runs the SP with the desired params and then returns
+        result set and columns if any.
+        '''
+        cursor = self._execute_stored_proc(schema, stored_proc, params)
         if cursor.description is not None:
             results = cursor.fetchall()
             columns = [cols[0] for cols in cursor.description]
@@ -139,13 +437,139 @@ class DBConnection:
             result_df = pd.DataFrame(data)
         return result_df
 
-    def get_df_from_stored_proc(self, schema, stored_proc, params=None):
-        results, columns = self.run_stored_proc(schema, stored_proc, params)
-        return self.get_df_from_result_set(results=results, columns=columns)
+    def get_df_from_cursor(self, cursor):
+        '''
+        This function fetches the result set of an executed cursor column
+        by column and returns it as a dataframe, without building a dict
+        per row. Decimal columns (as reported by cursor.description) are
+        converted to float in bulk. The cursor is closed afterwards.
+        Follows the same empty result conventions as get_df_from_result_set.
+        '''
+        try:
+            if cursor.description is None:
+                return pd.DataFrame()
+            description = cursor.description
+            results = cursor.fetchall()
+        finally:
+            cursor.close()
+        return self._get_columnar_df(results, description)
+
+    @staticmethod
+    def _get_columnar_df(results, description):
+        '''
+        This function transposes the rows into per column arrays and
+        builds the dataframe from them.
+        '''
+        columns = [cols[0] for cols in description]
+        if len(results) == 0:
+            return pd.DataFrame(columns=columns, dtype=object)
+        # keyed by position, result sets may repeat a column name
+        data = {}
+        for i, values in enumerate(zip(*results)):
+            if description[i][1] is decimal.Decimal:
+                data[i] = np.array(values, dtype=object).astype(float)
+            else:
+                data[i] = values
+        result_df = pd.DataFrame(data, columns=range(len(columns)))
+        result_df.columns = columns
+        return result_df
+
+    def get_cache_database(self):
+        '''
+        This function returns the (server, db_name) the result_cache keys
+        of this connection are scoped to.
+        '''
+        return (self.server.lower(), self.db_name.lower())
+
+    def get_df_from_stored_proc(
+        self, schema, stored_proc, params=None, columnar=True,
+        use_cache=False
+    ):
+        '''
+        columnar = False falls back to building the dataframe row by row
+        through get_df_from_result_set
+        use_cache = True serves the result from the result_cache of the
+        connection, if it has one. Only pass it for procs which do not
+        write, a cached call does not run the proc again.
+        '''
+        if self.result_cache is not None and use_cache:
+            return self.result_cache.get_or_load(
+                ResultCache.stored_proc_key(
+                    schema, stored_proc, params, self.get_cache_database()),
+                lambda: self.get_df_from_stored_proc(
+                    schema, stored_proc, params, columnar, use_cache=False)
+            )
+        if not columnar:
+            results, columns = self.run_stored_proc(
+                schema, stored_proc, params)
+            return self.get_df_from_result_set(
+                results=results, columns=columns)
+        cursor = self._execute_stored_proc(schema, stored_proc, params)
+        return self.get_df_from_cursor(cursor)
 
-    def get_df_from_query(self, query):
-        results, columns = self.run_sql_query(query)
-        return self.get_df_from_result_set(results=results, columns=columns)
+    def get_df_from_query(self, query, columnar=True, use_cache=False):
+        '''
+        columnar = False falls back to building the dataframe row by row
+        through get_df_from_result_set
+        use_cache = True serves the result from the result_cache of the
+        connection, if it has one. Only pass it for read only queries, a
+        cached call does not run the query again.
+        '''
+        if self.result_cache is not None and use_cache:
+            return self.result_cache.get_or_load(
+                ResultCache.query_key(query, self.get_cache_database()),
+                lambda: self.get_df_from_query(
+                    query, columnar, use_cache=False)
+            )
+        if not columnar:
+            results, columns = self.run_sql_query(query)
+            return self.get_df_from_result_set(
+                results=results, columns=columns)
+        cursor = self._execute_query(query)
+        return self.get_df_from_cursor(cursor)
+
+    def iter_cursor_chunks(self, cursor, chunk_rows=10000, as_df=True):
+        '''
+        This function is a generator which fetches the result set of an
+        executed cursor with fetchmany, chunk_rows rows at a time, and
+        yields every chunk as a dataframe (as_df = True) or as a list of
+        row tuples (as_df = False). The cursor stays open until the result
+        set is exhausted or the generator is closed by the caller.
+        Nothing is yielded for a non-result set cursor.
+        '''
+        try:
+            if cursor.description is None:
+                return
+            description = cursor.description
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if len(rows) == 0:
+                    break
+                if as_df:
+                    yield self._get_columnar_df(rows, description)
+                else:
+                    yield [tuple(row) for row in rows]
+        finally:
+            cursor.close()
+
+    def iter_query_chunks(self, query, chunk_rows=10000, as_df=True):
+        '''
+        This function runs the query and yields the result set in chunks
+        of chunk_rows rows, so that the complete result set never has to be
+        held in memory.
+        '''
+        cursor = self._execute_query(query)
+        return self.iter_cursor_chunks(cursor, chunk_rows, as_df)
+
+    def iter_stored_proc_chunks(
+        self, schema, stored_proc, params=None, chunk_rows=10000, as_df=True
+    ):
+        '''
+        This function runs the SP with the desired params and yields the
+        result set in chunks of chunk_rows rows.
+        '''
+        cursor = self._execute_stored_proc(schema, stored_proc, params)
+        return self.iter_cursor_chunks(cursor, chunk_rows, as_df)
 
     @staticmethod
     def _format_result_set(results, columns):
@@ -162,7 +586,54 @@ class DBConnection:
             yield output
 
     @staticmethod
-    def form_query_from_df(schema, sp_name, input_df, table_type_name):
+    def _format_sql_literal(item):
+        '''
+        This function formats a single value as a sql literal.
+        '''
+        if isinstance(item, (pd.Timestamp, str)):
+            return "'" + str(item).replace("'", "''") + "'"
+        if pd.isnull(item):
+            return "NULL"
+        return f"{item}"
+
+    @classmethod
+    def _format_sql_literals(cls, series):
+        '''
+        This function formats a whole column as sql literals in one step.
+        Timestamps and strings are quoted with embedded quotes escaped,
+        nulls become NULL and numbers are formatted as they are.
+        '''
+        if pd.api.types.is_numeric_dtype(series):
+            literals = [str(value) for value in series.tolist()]
+        elif pd.api.types.is_datetime64_dtype(series) and (
+            (series.values.astype('datetime64[s]') == series.values)
+            | np.isnat(series.values)
+        ).all():
+            # whole seconds format like str(pd.Timestamp), done by numpy
+            values = series.values.astype('datetime64[s]').astype(str)
+            literals = [
+                "'" + value.replace('T', ' ') + "'"
+                for value in values.tolist()
+            ]
+        elif pd.api.types.infer_dtype(series, skipna=True) == 'string':
+            literals = [
+                "'" + value.replace("'", "''") + "'"
+                if isinstance(value, str) else "NULL"
+                for value in series.tolist()
+            ]
+        else:
+            literals = [
+                cls._format_sql_literal(value) for value in series.tolist()]
+        null_mask = series.isnull().values
+        if null_mask.any():
+            literals = [
+                "NULL" if is_null else literal
+                for literal, is_null in zip(literals, null_mask)
+            ]
+        return literals
+
+    @classmethod
+    def form_query_from_df(cls, schema, sp_name, input_df, table_type_name):
         '''
         This is a static method which can be used to create dynamic
         sp execution query with one table type parameter from a df as
@@ -176,27 +647,78 @@ class DBConnection:
             query_start += f"[{col}],"
         query_start = query_start.rstrip(",")
         query_start += ") "
-        query_rows = ""
-        for _, row in input_df.iterrows():
-            each_row = "SELECT "
-            for item in row:
-                if isinstance(item, (pd.Timestamp, str)):
-                    each_row += f"'{item}',"
-                else:
-                    if pd.isnull(item):
-                        each_row += "NULL,"
-                    else:
-                        each_row += f"{item},"
-            each_row = each_row.rstrip(",")
-            each_row += " UNION ALL "
-            query_rows += each_row
-        query_rows = query_rows.rstrip(" UNION ALL ")
+        literals = [
+            cls._format_sql_literals(input_df.iloc[:, i])
+            for i in range(len(input_df.columns))
+        ]
+        query_rows = " UNION ALL ".join(
+            "SELECT " + ",".join(row) for row in zip(*literals)
+        )
         query_rows += ';'
         query_end = f"EXEC [{schema}].[{sp_name}] @InputVar"
         query = query_start + query_rows + query_end
         return query
 
-    def insert_data_from_df(self, schema, sp_name, input_df, table_type_name):
+    @staticmethod
+    def _get_param_rows(input_df):
+        '''
+        This function converts the df into a list of row tuples holding
+        python values, with None in place of nulls, to be bound as
+        parameters.
+        '''
+        data = input_df.astype(object)
+        data = data.where(pd.notnull(data), None)
+        return list(data.itertuples(index=False, name=None))
+
+    def _bulk_exec_sp_from_df(
+        self, schema, sp_name, input_df, table_type_name
+    ):
+        '''
+        This function binds the rows of the df as parameters with
+        fast_executemany into a session temp table shaped like the table
+        type, copies the temp table into the table type variable and
+        executes the sp with it. Returns the cursor of the sp execution.
+        '''
+        staging_table = '#InputVarStaging'
+        columns = ','.join(f'[{col}]' for col in input_df.columns)
+        placeholders = ','.join('?' for _ in input_df.columns)
+        create_stmt = "SET NOCOUNT ON;"
+        create_stmt += f"IF OBJECT_ID('tempdb..{staging_table}') IS NOT NULL "
+        create_stmt += f"DROP TABLE {staging_table};"
+        create_stmt += f"DECLARE @InputVar [{schema}].[{table_type_name}];"
+        create_stmt += f"SELECT {columns} INTO {staging_table} FROM @InputVar;"
+        insert_stmt = f"INSERT INTO {staging_table} ({columns}) "
+        insert_stmt += f"VALUES ({placeholders})"
+        exec_stmt = "SET NOCOUNT ON;"
+        exec_stmt += f"DECLARE @InputVar [{schema}].[{table_type_name}];"
+        exec_stmt += f"INSERT INTO @InputVar ({columns}) "
+        exec_stmt += f"SELECT {columns} FROM {staging_table};"
+        exec_stmt += f"DROP TABLE {staging_table};"
+        exec_stmt += f"EXEC [{schema}].[{sp_name}] @InputVar;"
+
+        # the temp table is created by a direct (unprepared) batch so that
+        # it lives for the session and not only for the statement scope
+        cursor = self._execute_query(create_stmt)
+        cursor.fast_executemany = True
+        cursor.executemany(insert_stmt, self._get_param_rows(input_df))
+        cursor.execute(exec_stmt)
+        return cursor
+
+    def insert_data_from_df(
+        self, schema, sp_name, input_df, table_type_name, bulk=False
+    ):
+        '''
+        bulk = True binds the rows as parameters through a staging table
+        (see _bulk_exec_sp_from_df) instead of inlining them into the
+        query text with form_query_from_df.
+        '''
+        if bulk:
+            if len(input_df) == 0:
+                return
+            cursor = self._bulk_exec_sp_from_df(
+                schema, sp_name, input_df, table_type_name)
+            cursor.close()
+            return
         query = self.form_query_from_df(
             schema,
             sp_name,
@@ -206,8 +728,14 @@ class DBConnection:
         self.run_sql_query(query)
 
     def get_result_df_from_input_df(
-        self, schema, sp_name, input_df, table_type_name
+        self, schema, sp_name, input_df, table_type_name, bulk=False
     ):
+        if bulk:
+            if len(input_df) == 0:
+                return pd.DataFrame()
+            cursor = self._bulk_exec_sp_from_df(
+                schema, sp_name, input_df, table_type_name)
+            return self.get_df_from_cursor(cursor)
         query = self.form_query_from_df(
             schema,
             sp_name,
@@ -215,27 +743,401 @@ class DBConnection:
             table_type_name
         )
         query = "SET NOCOUNT ON;" + query
-        return self.get_df_from_query(query)
+        # the query inserts and executes the proc, never serve it cached
+        return self.get_df_from_query(query, use_cache=False)
+
 
-   
-def insert_data_in_parts(db_obj, schema, sp_name, input_df, table_type_name):
+class DBConnectionPool:
+    '''
+    Class DBConnectionPool keeps a thread safe pool of DBConnection objects
+    to the same database, so that concurrent workers can run queries
+    without sharing one connection or opening one per task.
+    Accepts the same arguments as DBConnection along with
+    min_size: connections opened upfront and kept even when idle
+    max_size: upper bound on open connections, checkout waits beyond it
+    idle_timeout: seconds after which an idle connection above min_size
+    is closed
+    max_lifetime: seconds after which a connection is closed and replaced
+    health_check_interval: a connection idle for longer than this is
+    probed with SELECT 1 before reuse and reconnected if the probe fails
+    checkout_timeout: seconds to wait for a free connection
+    '''
+    def __init__(self, server, db_name, user_name, pwd, **kwargs):
+        self.server = server
+        self.db_name = db_name
+        self.user_name = user_name
+        self.pwd = pwd
+        self.min_size = kwargs.pop('min_size', 1)
+        self.max_size = kwargs.pop('max_size', 10)
+        self.idle_timeout = kwargs.pop('idle_timeout', 300)
+        self.max_lifetime = kwargs.pop('max_lifetime', 3600)
+        self.health_check_interval = kwargs.pop('health_check_interval', 30)
+        self.checkout_timeout = kwargs.pop('checkout_timeout', 30)
+        self.args = kwargs
+        self._condition = threading.Condition()
+        # idle connections as (db_conn, created_at, last_used_at),
+        # the most recently used one at the right end
+        self._idle = deque()
+        self._created_at = {}
+        self._size = 0
+        self._closed = False
+        self._executor = None
+        for _ in range(self.min_size):
+            db_conn = self._create_connection()
+            self._size += 1
+            self._idle.append(
+                (db_conn, self._created_at[id(db_conn)], time.monotonic()))
+
+    def _create_connection(self):
+        db_conn = DBConnection(
+            self.server, self.db_name, self.user_name, self.pwd, **self.args)
+        self._created_at[id(db_conn)] = time.monotonic()
+        return db_conn
+
+    def _discard_connection(self, db_conn):
+        self._created_at.pop(id(db_conn), None)
+        try:
+            db_conn.close()
+        except pyodbc.Error:
+            pass
+
+    @staticmethod
+    def _is_alive(db_conn):
+        try:
+            cursor = db_conn.connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def _pop_expired(self, now):
+        '''
+        This function removes the idle connections which are past their
+        max lifetime, or past the idle timeout while the pool is above
+        min_size, and returns them to be closed outside of the lock.
+        '''
+        expired = []
+        for entry in list(self._idle):
+            db_conn, created_at, last_used_at = entry
+            too_old = now - created_at > self.max_lifetime
+            too_idle = (
+                now - last_used_at > self.idle_timeout
+                and self._size > self.min_size
+            )
+            if too_old or too_idle:
+                self._idle.remove(entry)
+                self._size -= 1
+                expired.append(db_conn)
+        return expired
+
+    def checkout(self, timeout=None):
+        '''
+        This function hands out a DBConnection from the pool, opening a new
+        one while the pool is below max_size, or else waiting up to timeout
+        seconds for one to be checked in.
+        Every connection checked out must be returned with checkin.
+        '''
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        db_conn = None
+        expired = []
+        try:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise SQLException('Connection pool is closed')
+                    now = time.monotonic()
+                    expired.extend(self._pop_expired(now))
+                    if self._idle:
+                        db_conn, _, last_used_at = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise SQLException(
+                            'Timed out waiting for a connection from the pool')
+                    self._condition.wait(remaining)
+        finally:
+            for expired_conn in expired:
+                self._discard_connection(expired_conn)
+
+        if db_conn is None:
+            try:
+                return self._create_connection()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+        if now - last_used_at > self.health_check_interval:
+            if not self._is_alive(db_conn):
+                # release the broken connection before opening a new one
+                try:
+                    db_conn.close()
+                except pyodbc.Error:
+                    pass
+                try:
+                    db_conn.refresh_connection()
+                except Exception:
+                    self._discard(db_conn)
+                    raise
+                self._created_at[id(db_conn)] = time.monotonic()
+        return db_conn
+
+    def _discard(self, db_conn):
+        self._discard_connection(db_conn)
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def checkin(self, db_conn, discard=False):
+        '''
+        This function returns a checked out DBConnection to the pool.
+        discard = True closes the connection instead, e.g. after it failed.
+        '''
+        now = time.monotonic()
+        created_at = self._created_at.get(id(db_conn), now)
+        expired = now - created_at > self.max_lifetime
+        with self._condition:
+            if not (discard or expired or self._closed):
+                self._idle.append((db_conn, created_at, now))
+                self._condition.notify()
+                return
+        self._discard(db_conn)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Context manager that checks out a DBConnection and checks it back
+        in on exit. A connection that raised a pyodbc OperationalError is
+        discarded.
+        '''
+        db_conn = self.checkout()
+        discard = False
+        try:
+            yield db_conn
+        except pyodbc.OperationalError:
+            discard = True
+            raise
+        finally:
+            self.checkin(db_conn, discard=discard)
+
+    def close(self):
+        '''
+        This function closes the idle connections and marks the pool as
+        closed, connections in use are closed when checked in.
+        '''
+        with self._condition:
+            self._closed = True
+            idle = [entry[0] for entry in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+        for db_conn in idle:
+            self._discard_connection(db_conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run_sql_query(self, query):
+        with self.connection() as db_conn:
+            return db_conn.run_sql_query(query)
+
+    def run_stored_proc(self, schema, stored_proc, params=None):
+        with self.connection() as db_conn:
+            return db_conn.run_stored_proc(schema, stored_proc, params)
+
+    def get_df_from_query(self, query, columnar=True, use_cache=False):
+        with self.connection() as db_conn:
+            return db_conn.get_df_from_query(query, columnar, use_cache)
+
+    def get_df_from_stored_proc(
+        self, schema, stored_proc, params=None, columnar=True,
+        use_cache=False
+    ):
+        with self.connection() as db_conn:
+            return db_conn.get_df_from_stored_proc(
+                schema, stored_proc, params, columnar, use_cache)
+
+    def iter_query_chunks(self, query, chunk_rows=10000, as_df=True):
+        '''
+        The connection stays checked out until the generator is exhausted
+        or closed.
+        '''
+        with self.connection() as db_conn:
+            yield from db_conn.iter_query_chunks(query, chunk_rows, as_df)
+
+    def iter_stored_proc_chunks(
+        self, schema, stored_proc, params=None, chunk_rows=10000, as_df=True
+    ):
+        '''
+        The connection stays checked out until the generator is exhausted
+        or closed.
+        '''
+        with self.connection() as db_conn:
+            yield from db_conn.iter_stored_proc_chunks(
+                schema, stored_proc, params, chunk_rows, as_df)
+
+    def insert_data_from_df(
+        self, schema, sp_name, input_df, table_type_name, bulk=False
+    ):
+        with self.connection() as db_conn:
+            db_conn.insert_data_from_df(
+                schema, sp_name, input_df, table_type_name, bulk)
+
+    def get_result_df_from_input_df(
+        self, schema, sp_name, input_df, table_type_name, bulk=False
+    ):
+        with self.connection() as db_conn:
+            return db_conn.get_result_df_from_input_df(
+                schema, sp_name, input_df, table_type_name, bulk)
+
+    def _get_executor(self):
+        with self._condition:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_size,
+                    thread_name_prefix='DBConnectionPool'
+                )
+            return self._executor
+
+    def _get_df_with_timeout(self, query, timeout=None):
+        '''
+        This function runs a query (str) or a stored proc
+        ((schema, stored_proc, params) tuple) on a pooled connection and
+        returns the dataframe. The timeout is also set as the query timeout
+        of the connection, so the server stops work nobody waits for.
+        '''
+        with self.connection() as db_conn:
+            if timeout is not None:
+                db_conn.connection.timeout = max(1, math.ceil(timeout))
+            try:
+                if isinstance(query, str):
+                    return db_conn.get_df_from_query(query)
+                return db_conn.get_df_from_stored_proc(*query)
+            finally:
+                if db_conn.connection is not None:
+                    db_conn.connection.timeout = 0
+
+    async def get_df_async(self, query, timeout=None):
+        '''
+        This function runs the query (str) or stored proc
+        ((schema, stored_proc, params) tuple) on the pool's executor and
+        returns the dataframe without blocking the event loop.
+        Raises asyncio.TimeoutError after timeout seconds.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._get_executor(),
+            functools.partial(self._get_df_with_timeout, query, timeout)
+        )
+        return await asyncio.wait_for(future, timeout)
+
+    async def run_many(self, queries, timeout=None, return_exceptions=False):
+        '''
+        This function runs the queries concurrently, at most max_size at a
+        time, and returns their dataframes in the same order. timeout
+        applies to every query on its own, return_exceptions = True returns
+        the exceptions of failed queries in place of their result instead
+        of raising the first one.
+        '''
+        return await asyncio.gather(
+            *(self.get_df_async(query, timeout) for query in queries),
+            return_exceptions=return_exceptions
+        )
+
+
+def _estimate_row_bytes(input_df, sample_rows=1000):
+    '''
+    This function estimates the in memory size of a row of the df from an
+    evenly spaced sample of rows.
+    '''
+    step = max(1, len(input_df) // sample_rows)
+    sample = input_df.iloc[::step]
+    sample_bytes = sample.memory_usage(index=False, deep=True).sum()
+    return max(1, int(sample_bytes / max(1, len(sample))))
+
+
+def insert_data_in_parts(
+    db_obj, schema, sp_name, input_df, table_type_name, bulk=False, **kwargs
+):
     '''
     This method is used to insert data into SQL
-    by dividing the Dataframe into batches if the total records in dataframe
-    are greater than 20k.
+    by dividing the Dataframe into batches. The batch size is derived from
+    the estimated row size so that a batch stays within max_batch_bytes
+    (default 16MB) and max_batch_rows (default 20k).
+    max_workers > 1 inserts the batches concurrently over that many
+    connections, db_obj can be a DBConnectionPool or a DBConnection, in
+    which case a temporary pool with the same settings is used.
+    Returns a list with the batch number, start and end index, row count
+    and elapsed seconds of every batch.
     '''
-    max_files_in_batch = 20000
-    batches = int (len(input_df)/max_files_in_batch)
-    print(f"Total Batches: {batches}")
-    
-    min_index = 0
-    for i in range (0, batches):
-        max_index = min_index + max_files_in_batch
-        print(f"Inserting Batch {i+1} from index: {min_index} to {max_index}")
-        data = input_df.iloc[min_index: max_index]
-        db_obj.insert_data_from_df(schema, sp_name, data, table_type_name)
-        min_index = max_index
-    if len(input_df) > max_index:
-        print(f"Inserting Remaining Data")
-        data = input_df.iloc[max_index:]
-        db_obj.insert_data_from_df(schema, sp_name, data, table_type_name)
+    max_batch_rows = kwargs.get('max_batch_rows', 20000)
+    max_batch_bytes = kwargs.get('max_batch_bytes', 16 * 1024 * 1024)
+    max_workers = kwargs.get('max_workers', 1)
+    if len(input_df) == 0:
+        return []
+    if bulk and len(input_df.columns) > MAX_SQL_PARAMS:
+        raise SQLException(
+            f'Cannot bind {len(input_df.columns)} columns as parameters, '
+            f'the limit is {MAX_SQL_PARAMS}')
+
+    row_bytes = _estimate_row_bytes(input_df)
+    batch_rows = max(1, min(max_batch_rows, max_batch_bytes // row_bytes))
+    bounds = [
+        (i + 1, min_index, min(min_index + batch_rows, len(input_df)))
+        for i, min_index in enumerate(range(0, len(input_df), batch_rows))
+    ]
+    LOGGER.info(
+        "Inserting %s rows in %s batches of up to %s rows",
+        len(input_df), len(bounds), batch_rows)
+
+    def insert_batch(target, batch, min_index, max_index):
+        LOGGER.info(
+            "Inserting Batch %s from index: %s to %s",
+            batch, min_index, max_index)
+        started = time.monotonic()
+        target.insert_data_from_df(
+            schema, sp_name, input_df.iloc[min_index: max_index],
+            table_type_name, bulk=bulk)
+        return {
+            'batch': batch,
+            'start': min_index,
+            'end': max_index,
+            'rows': max_index - min_index,
+            'seconds': time.monotonic() - started
+        }
+
+    if max_workers <= 1 or len(bounds) == 1:
+        return [insert_batch(db_obj, *bound) for bound in bounds]
+
+    if isinstance(db_obj, DBConnectionPool):
+        pool = db_obj
+    else:
+        pool = DBConnectionPool(
+            db_obj.server, db_obj.db_name, db_obj.user_name, db_obj.pwd,
+            min_size=0, max_size=max_workers, **db_obj.args)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(insert_batch, pool, *bound)
+                for bound in bounds
+            ]
+            try:
+                return [future.result() for future in futures]
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        if pool is not db_obj:
+            pool.close()
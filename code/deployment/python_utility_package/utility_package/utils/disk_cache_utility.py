@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError, ResourceNotModifiedError)
+
+
+class DiskCache:
+    '''
+    Class DiskCache keeps downloaded file content on local disk along with
+    its ETag, so that reading a file which has not changed only costs a
+    conditional request (If-None-Match) to the storage account.
+    Every entry is a single file replaced atomically, so one cache
+    directory can be shared by several processes. Once the directory holds
+    more than max_bytes, the least recently read entries are evicted.
+    '''
+    def __init__(self, cache_dir: str, max_bytes=1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_path(self, key: str):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{digest}.entry')
+
+    def get(self, key: str):
+        '''
+        This method returns the (etag, data) cached for the key or None.
+        An entry file holds a json header line followed by the content.
+        '''
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as entry_file:
+                header = json.loads(entry_file.readline())
+                data = entry_file.read()
+            # the modification time orders the entries for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if header.get('key') != key:
+            return None
+        return header['etag'], data
+
+    def put(self, key: str, etag: str, data: bytes):
+        header = json.dumps({'key': key, 'etag': etag}).encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(header + b'\n')
+                tmp_file.write(data)
+            os.replace(tmp_path, self._get_path(key))
+        except OSError:
+            # another process may hold the entry open, the next read
+            # downloads the content again
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.entry'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def read_through(self, key: str, download, name=None):
+        '''
+        This method returns the content for the key as a CachedDownload,
+        revalidating a cached entry. download(**kwargs) must return a
+        StorageStreamDownloader and is called with etag/match_condition
+        when an entry is cached, raising a 304 HttpResponseError (or its
+        subclass ResourceNotModifiedError, depending on the SDK version) if
+        the cached content is still current.
+        '''
+        cached = self.get(key)
+        if cached is None:
+            downloader = download()
+        else:
+            etag, data = cached
+            try:
+                downloader = download(
+                    etag=etag, match_condition=MatchConditions.IfModified)
+            except HttpResponseError as err:
+                if not (
+                    isinstance(err, ResourceNotModifiedError)
+                    or err.status_code == 304
+                ):
+                    raise
+                return CachedDownload(data, etag, name)
+        data = downloader.readall()
+        etag = downloader.properties.etag
+        self.put(key, etag, data)
+        return CachedDownload(data, etag, name)
+
+
+class CachedProperties:
+    '''
+    Class CachedProperties holds the properties known for content served
+    by DiskCache: name, etag and size.
+    '''
+    def __init__(self, name, etag, size):
+        self.name = name
+        self.etag = etag
+        self.size = size
+
+
+class CachedDownload:
+    '''
+    Class CachedDownload stands in for the StorageStreamDownloader of a
+    download served by DiskCache.
+    '''
+    def __init__(
+        self, data: bytes, etag=None, name=None, chunk_size=4 * 1024 * 1024
+    ):
+        self.data = data
+        self.name = name
+        self.size = len(data)
+        self.properties = CachedProperties(name, etag, self.size)
+        self.chunk_size = chunk_size
+
+    def readall(self):
+        return self.data
+
+    # max_concurrency is only accepted for compatibility with the SDK
+    def content_as_bytes(self, max_concurrency=1):  # pylint: disable=W0613
+        return self.data
+
+    def content_as_text(  # pylint: disable=W0613
+        self, max_concurrency=1, encoding='UTF-8'
+    ):
+        return self.data.decode(encoding)
+
+    def readinto(self, stream):
+        stream.write(self.data)
+        return self.size
+
+    def chunks(self):
+        for start in range(0, self.size, self.chunk_size):
+            yield self.data[start: start + self.chunk_size]
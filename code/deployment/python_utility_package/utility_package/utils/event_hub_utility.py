@@ -31,8 +31,16 @@ class EventHubConnection:
         )
         self.kv_client = KeyvaultSecretsUtility(
             spn_credentials,
-            self.config['keyvault'][0]['name']
+            self.config['keyvault'][0]['name'],
+            cache_ttl=self.config['keyvault'][0].get('cache_ttl', 300)
         )
+        if self.kv_client.cache_ttl is not None:
+            # fetch the secrets used below in one concurrent round trip
+            self.kv_client.get_secrets([
+                self.config['blob_details'][0]['blob_conn_str_secret'],
+                self.config['event_hub'][0][
+                    'event_hub_namespace_conn_str_secret']
+            ])
         self.consumer_group = consumer_group
         self.checkpoint_store = self._create_checkpoint_store()
         self.consumer_client = self._get_event_hub_consumer_client()
@@ -1,16 +1,38 @@
+import time
+
 from azure.keyvault.secrets import SecretClient
 from azure.identity import ClientSecretCredential
 from azure.core.exceptions import ResourceNotFoundError
 
+from utility_package.utils.concurrency_utility import imap_unordered
+from utility_package.utils.refresh_cache_utility import RefreshingCache
+
+
+# process wide, keyed by (vault url, secret name), so every
+# KeyvaultSecretsUtility for a vault shares the fetched secrets
+SECRET_CACHE = RefreshingCache(refresh_margin=0)
+
 
 class KeyvaultSecretsUtility:
     '''
     Interface to the Azure KeyVault Python SDK. This class
     helps to get a keyvault client by passing spn_creds
     (spn_id, spn_password, tenant_id) and keyvault name
+    cache_ttl: seconds a fetched secret is reused for, None (default)
+    fetches it on every call. Once a cached secret is older than
+    cache_ttl - refresh_margin (cache_ttl / 5 by default) it is still
+    served while it is fetched again in the background. Cached secrets
+    are shared by every instance for the same vault.
     '''
-    def __init__(self, spn_credentials, kv_name):
+    def __init__(
+        self, spn_credentials, kv_name, cache_ttl=None, refresh_margin=None
+    ):
         self.client = None
+        self.cache_ttl = cache_ttl
+        self.refresh_margin = (
+            refresh_margin if refresh_margin is not None
+            else (cache_ttl or 0) / 5
+        )
         self.spn_client_id = spn_credentials['spn_id']
         self.spn_client_secret = spn_credentials['spn_password']
         self.tenant_id = spn_credentials['tenant_id']
@@ -38,14 +60,50 @@ class KeyvaultSecretsUtility:
             vault_url=self.url,
             credential=credential)
 
-    def get_secret(self, secret_name):
-        '''
-        This method is used to fetch the secret value using thing
-        secret client
-        '''
+    def _fetch_secret(self, secret_name):
         try:
             secret = self.client.get_secret(secret_name)
             return secret.name, secret.value
         except ResourceNotFoundError as err:
             msg = 'Secret {} not found \n {}'.format(secret_name, err)
             raise ResourceNotFoundError(msg)
+
+    def get_secret(self, secret_name):
+        '''
+        This method is used to fetch the secret value using thing
+        secret client, served from the cache when cache_ttl is set
+        '''
+        if self.cache_ttl is None:
+            return self._fetch_secret(secret_name)
+
+        def fetch():
+            return (
+                self._fetch_secret(secret_name), time.time() + self.cache_ttl)
+
+        return SECRET_CACHE.get(
+            (self.url, secret_name), fetch, self.refresh_margin)
+
+    def get_secrets(self, secret_names, max_workers=8):
+        '''
+        This method fetches the secrets concurrently, at most max_workers
+        at a time, and returns a dict of secret name to value. The first
+        failure is raised once every fetch has completed.
+        '''
+        secrets = {}
+        errors = []
+        for secret_name, secret, error in imap_unordered(
+            self.get_secret, list(dict.fromkeys(secret_names)), max_workers
+        ):
+            if error is not None:
+                errors.append(error)
+                continue
+            secrets[secret_name] = secret[1]
+        if errors:
+            raise errors[0]
+        return secrets
+
+    def clear_cache(self):
+        '''
+        This method removes the cached secrets of this vault
+        '''
+        SECRET_CACHE.invalidate_matching(lambda key: key[0] == self.url)
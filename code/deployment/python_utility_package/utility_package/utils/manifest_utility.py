@@ -0,0 +1,101 @@
+import gzip
+import json
+import os
+import tempfile
+
+
+class PathManifest:
+    '''
+    Class PathManifest is a compact local record of the files seen by a
+    listing, mapping every name to its [size, etag, last_modified], kept in
+    a gzipped json file at manifest_path.
+    compare checks a new listing against the manifest without changing it,
+    commit replaces the manifest file atomically, so a run which fails
+    before committing leaves the previous state in place.
+    '''
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with gzip.open(self.manifest_path, 'rt', encoding='utf-8') as file:
+            return json.load(file)
+
+    @staticmethod
+    def get_entry(size, etag, last_modified):
+        return [size, etag, str(last_modified)]
+
+    def compare(self, entries):
+        '''
+        This method compares a listing, an iterable of
+        (name, size, etag, last_modified, item) tuples, with the manifest.
+        Returns (changed, deleted, state): the items which are new or
+        differ in size, etag or last_modified, the names which are no
+        longer listed and the new state to pass to commit.
+        '''
+        changed = []
+        state = {}
+        for name, size, etag, last_modified, item in entries:
+            entry = self.get_entry(size, etag, last_modified)
+            state[name] = entry
+            if self.entries.get(name) != entry:
+                changed.append(item)
+        deleted = [name for name in self.entries if name not in state]
+        return changed, deleted, state
+
+    def commit(self, state):
+        '''
+        This method makes state the current manifest and writes it to
+        manifest_path with an atomic replace.
+        '''
+        directory = os.path.dirname(os.path.abspath(self.manifest_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                with gzip.open(tmp_file, 'wt', encoding='utf-8') as file:
+                    json.dump(state, file, separators=(',', ':'))
+            os.replace(tmp_path, self.manifest_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.entries = state
+
+
+class ChangeTracker:
+    '''
+    Class ChangeTracker reports the files which changed since the last
+    processed listing in two steps: get_changes compares a new listing
+    with the PathManifest at manifest_path, commit records that listing
+    once the caller has processed the changes, so a run which fails in
+    between sees the same changes again.
+    list_entries: callable returning the listing as
+    (name, size, etag, last_modified, item) tuples
+    '''
+    def __init__(self, manifest_path: str, list_entries):
+        self.manifest = PathManifest(manifest_path)
+        self.list_entries = list_entries
+        self._state = None
+
+    def get_changes(self):
+        '''
+        This method lists the files and returns (changed, deleted): the
+        items which are new or changed and the names of the files deleted
+        since the last commit.
+        '''
+        changed, deleted, self._state = self.manifest.compare(
+            self.list_entries())
+        return changed, deleted
+
+    def commit(self):
+        '''
+        This method records the listing of the last get_changes call as
+        processed.
+        '''
+        if self._state is None:
+            raise ValueError('get_changes needs to be called before commit')
+        self.manifest.commit(self._state)
+        self._state = None
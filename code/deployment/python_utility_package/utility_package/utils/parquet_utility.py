@@ -0,0 +1,117 @@
+import operator
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# filter operators, applied as (column, op, value) tuples
+_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda series, values: series.isin(values),
+}
+
+
+def _require_pyarrow():
+    if pq is None:
+        raise ImportError(
+            'pyarrow needs to be installed to read and write parquet')
+
+
+def write_parquet(
+    dataframe, file, row_group_size=None, compression='snappy'
+):
+    '''
+    This function writes the dataframe as parquet to the file Object,
+    with up to row_group_size rows per row group.
+    '''
+    _require_pyarrow()
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    pq.write_table(
+        table, file, row_group_size=row_group_size, compression=compression)
+
+
+def _row_group_may_match(row_group, column_indexes, filters):
+    '''
+    This function uses the min/max statistics of the row group to tell
+    whether any of its rows can pass the filters.
+    '''
+    for column, op, value in filters:
+        stats = row_group.column(column_indexes[column]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        low, high = stats.min, stats.max
+        try:
+            if op == '==' and (value < low or value > high):
+                return False
+            if op == 'in' and all(v < low or v > high for v in value):
+                return False
+            if op == '<' and not low < value:
+                return False
+            if op == '<=' and not low <= value:
+                return False
+            if op == '>' and not high > value:
+                return False
+            if op == '>=' and not high >= value:
+                return False
+        except TypeError:
+            # statistics of a type the value cannot be compared with
+            continue
+    return True
+
+
+def read_parquet(file, columns=None, filters=None, row_groups=None):
+    '''
+    This function reads parquet from a seekable file Object into a
+    dataframe, reading only the footer and the column chunks needed.
+    columns: the columns to read, all when None
+    filters: list of (column, op, value) tuples which all have to hold,
+    op is one of ==, !=, <, <=, >, >=, in. Row groups whose statistics
+    rule the filters out are skipped, the remaining rows are filtered.
+    row_groups: indexes of the row groups to read, all when None
+    '''
+    _require_pyarrow()
+    parquet_file = pq.ParquetFile(file)
+    metadata = parquet_file.metadata
+    if row_groups is None:
+        row_groups = range(metadata.num_row_groups)
+    filters = filters or []
+    if filters and metadata.num_row_groups > 0:
+        first_row_group = metadata.row_group(0)
+        column_indexes = {
+            first_row_group.column(i).path_in_schema: i
+            for i in range(first_row_group.num_columns)
+        }
+        row_groups = [
+            i for i in row_groups
+            if _row_group_may_match(
+                metadata.row_group(i), column_indexes, filters)
+        ]
+    read_columns = columns
+    if columns is not None:
+        read_columns = list(columns) + [
+            column for column, _, _ in filters if column not in columns]
+    if len(row_groups) > 0:
+        table = parquet_file.read_row_groups(
+            list(row_groups), columns=read_columns)
+    else:
+        table = parquet_file.schema_arrow.empty_table()
+        if read_columns is not None:
+            table = table.select(read_columns)
+    dataframe = table.to_pandas()
+    if filters:
+        mask = None
+        for column, op, value in filters:
+            column_mask = _OPERATORS[op](dataframe[column], value)
+            mask = column_mask if mask is None else mask & column_mask
+        dataframe = dataframe[mask].reset_index(drop=True)
+    if columns is not None:
+        dataframe = dataframe[list(columns)]
+    return dataframe
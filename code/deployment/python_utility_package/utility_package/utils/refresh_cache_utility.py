@@ -0,0 +1,106 @@
+import threading
+import time
+
+
+class _RefreshEntry:
+    def __init__(self):
+        self.value = None
+        self.expires_at = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+
+class RefreshingCache:
+    '''
+    Class RefreshingCache is a thread safe cache of values which expire,
+    e.g. access tokens or secrets. get(key, fetch) calls fetch() on a miss,
+    which returns (value, expires_at) with expires_at in time.time()
+    seconds.
+    A value is served until it is within refresh_margin seconds of expiry
+    (get can override it per call), from then on it is still served while
+    it is fetched again in the background. Only a value within
+    min_validity seconds of expiry is fetched while the caller waits, and
+    concurrent misses for one key share a single fetch.
+    '''
+    def __init__(self, refresh_margin, min_validity=0):
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _RefreshEntry()
+                self._entries[key] = entry
+            return entry
+
+    @staticmethod
+    def _is_valid(entry, margin):
+        return (
+            entry.expires_at is not None
+            and entry.expires_at - time.time() > margin
+        )
+
+    @staticmethod
+    def _fetch(entry, fetch):
+        entry.value, entry.expires_at = fetch()
+        return entry.value
+
+    def _refresh_in_background(self, entry, fetch, refresh_margin):
+        with self._lock:
+            if entry.refreshing:
+                return
+            entry.refreshing = True
+
+        def refresh():
+            try:
+                with entry.lock:
+                    if not self._is_valid(entry, refresh_margin):
+                        self._fetch(entry, fetch)
+            except Exception:  # pylint: disable=W0703
+                # the value is fetched on demand once it is close to expiry
+                pass
+            finally:
+                entry.refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get(self, key, fetch, refresh_margin=None):
+        '''
+        This method returns the value cached for the key, fetching it with
+        fetch() when it is missing or about to expire.
+        '''
+        if refresh_margin is None:
+            refresh_margin = self.refresh_margin
+        entry = self._get_entry(key)
+        if not self._is_valid(entry, self.min_validity):
+            with entry.lock:
+                if not self._is_valid(entry, self.min_validity):
+                    return self._fetch(entry, fetch)
+                return entry.value
+        value = entry.value
+        if not self._is_valid(entry, refresh_margin):
+            self._refresh_in_background(entry, fetch, refresh_margin)
+        return value
+
+    def invalidate(self, key=None):
+        '''
+        This method removes the value for the key, or every value when no
+        key is passed.
+        '''
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_matching(self, matches):
+        '''
+        This method removes the values of every key for which
+        matches(key) is True.
+        '''
+        with self._lock:
+            for key in [key for key in self._entries if matches(key)]:
+                del self._entries[key]
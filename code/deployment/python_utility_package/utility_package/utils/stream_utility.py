@@ -0,0 +1,69 @@
+import io
+import mmap
+
+
+def open_read_only_mmap(file_path: str):
+    '''
+    This function maps the local file read only into memory and returns
+    the mmap.mmap Object, or empty bytes for an empty file (which cannot
+    be mapped).
+    '''
+    with open(file_path, 'rb') as file:
+        file.seek(0, 2)
+        if file.tell() == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class RangeReader(io.RawIOBase):
+    '''
+    Read only, seekable file like Object over a remote file of a known
+    size. Every read is served by read_range(offset, length), so readers
+    which seek around (e.g. parquet readers) only download the byte ranges
+    they actually use. Wrap it in io.BufferedReader to batch small reads.
+    '''
+    def __init__(self, read_range, size: int):
+        super().__init__()
+        self._read_range = read_range
+        self.size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        if pos < 0:
+            raise ValueError(f'Negative seek position {pos}')
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self._pos)
+        if length <= 0:
+            return 0
+        data = self._read_range(self._pos, length)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+def open_range_reader(read_range, size: int, block_size=4 * 1024 * 1024):
+    '''
+    This function returns a buffered RangeReader which downloads at least
+    block_size bytes per request.
+    '''
+    return io.BufferedReader(RangeReader(read_range, size), block_size)